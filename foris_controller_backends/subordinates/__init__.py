@@ -21,12 +21,20 @@ import os
 import logging
 import tarfile
 import base64
+import binascii
+import bisect
+import collections
+import hashlib
+import io
 import json
 import pathlib
+import re
 import shutil
+import threading
+import time
 import typing
+import uuid
 
-from io import BytesIO
 
 from foris_controller.app import app_info
 
@@ -37,8 +45,6 @@ from foris_controller_backends.uci import (
     UciException,
     store_bool,
     get_sections_by_type,
-    get_section,
-    UciRecordNotFound,
 )
 from foris_controller.utils import RWLock
 from foris_controller_backends.services import OpenwrtServices
@@ -49,247 +55,1509 @@ logger = logging.getLogger(__name__)
 subordinate_dir_lock = RWLock(app_info["lock_backend"])
 
 
-class SubordinatesUci(object):
-    def _get_options_section(
-        self, data: dict, controller_id: str, section_type: str
-    ) -> typing.Optional[dict]:
-        for section in get_sections_by_type(data, "foris-controller-subordinates", section_type):
-            if section["name"] == controller_id:
-                return section
-        return None
+class SubordinatesRegistry:
+    """ Indexed snapshot of subordinates stored in uci
 
-    def _get_fosquitto_section(
-        self, data: dict, controller_id: str, section_type: str
-    ) -> typing.Optional[dict]:
-        for section in get_sections_by_type(data, "fosquitto", section_type):
-            if section["name"] == controller_id:
-                return section
-        return None
+    Snapshot is cached and shared between all the callers until one of the
+    underlying config files is changed (detected via inode/mtime/size) or until
+    it is explicitly invalidated after a write.
+    """
 
-    def list_subordinates(self):
-        with UciBackend() as backend:
-            fosquitto_data = backend.read("fosquitto")
-            sub_data = backend.read("foris-controller-subordinates")
+    CONFIGS = ("fosquitto", "foris-controller-subordinates")
 
-        res = []
-        subordinates_map = {}
+    _lock = threading.Lock()
+    _cached: typing.Optional["SubordinatesRegistry"] = None
+    _cached_stamp: typing.Optional[tuple] = None
+    # revision is increased whenever the content changes
+    # (it is seeded by time so it keeps increasing after the controller is restarted,
+    # the last revision is stored as well for devices which boot without a valid clock)
+    REVISION_FILE = pathlib.Path("/etc/fosquitto/bridges/.revision")
+    _revision: typing.Optional[int] = None
+    _revision_digest: typing.Optional[str] = None
+    _revision_records: typing.Optional[typing.Dict[str, dict]] = None
+    # (previous revision, revision, affected controller_ids)
+    JOURNAL_SIZE = 256
+    _journal: typing.Deque[typing.Tuple[int, int, typing.FrozenSet[str]]] = collections.deque(
+        maxlen=JOURNAL_SIZE
+    )
+
+    def __init__(self, fosquitto_data: dict, sub_data: dict):
+        self.revision = 0
+        # controller_id -> fosquitto section data (ordered as in config)
+        self.subordinates: typing.Dict[str, dict] = {}
+        self.subsubordinates: typing.Dict[str, dict] = {}
+        # controller_id of subordinate -> controller_ids of its subsubordinates
+        self.via: typing.Dict[str, typing.List[str]] = {}
+        # (section_type, controller_id) -> custom_name
+        self.custom_names: typing.Dict[typing.Tuple[str, str], str] = {}
+        # coalescing window of fosquitto restarts (None => default)
+        self.restart_delay: typing.Optional[float] = None
+
+        for section in get_sections_by_type(fosquitto_data, "fosquitto", "subordinate"):
+            self.subordinates[section["name"]] = section["data"]
 
-        for item in get_sections_by_type(fosquitto_data, "fosquitto", "subsubordinate"):
-            if "via" in item["data"]:
-                controller_id = item["name"]
+        for section in get_sections_by_type(fosquitto_data, "fosquitto", "subsubordinate"):
+            self.subsubordinates[section["name"]] = section["data"]
+            if "via" in section["data"]:
+                self.via.setdefault(section["data"]["via"], []).append(section["name"])
 
-                # try to get options
-                options = {"custom_name": ""}
-                options_section = self._get_options_section(
-                    sub_data, controller_id, "subsubordinate"
+        for section_type in ("subordinate", "subsubordinate"):
+            for section in get_sections_by_type(
+                sub_data, "foris-controller-subordinates", section_type
+            ):
+                self.custom_names.setdefault(
+                    (section_type, section["name"]), section["data"].get("custom_name", "")
                 )
-                if options_section:
-                    options["custom_name"] = options_section["data"].get("custom_name", "")
-
-                subsubs = subordinates_map.get(item["data"]["via"], [])
-                subsubs.append(
-                    {
-                        "controller_id": controller_id,
-                        "options": options,
-                        "enabled": parse_bool(item["data"].get("enabled", "1")),
-                    }
+
+        for section in get_sections_by_type(sub_data, "foris-controller-subordinates", "settings"):
+            try:
+                self.restart_delay = max(float(section["data"]["restart_delay"]), 0.0)
+            except (KeyError, ValueError):
+                pass  # not set or invalid
+
+        # lazily built indexes
+        self._names: typing.Optional[typing.List[typing.Tuple[str, str]]] = None
+        self._positions: typing.Optional[typing.Dict[str, int]] = None
+        self._stats: typing.Optional[dict] = None
+
+    @staticmethod
+    def _stamp() -> typing.Optional[tuple]:
+        config_dir = getattr(UciBackend(), "config_dir", None) or "/etc/config"
+        try:
+            stats = [
+                os.stat(os.path.join(config_dir, config))
+                for config in SubordinatesRegistry.CONFIGS
+            ]
+        except OSError:
+            return None  # unable to detect changes => don't cache
+        return tuple((e.st_ino, e.st_mtime_ns, e.st_size) for e in stats)
+
+    @staticmethod
+    def _stored_revision() -> int:
+        path = inject_file_root(str(SubordinatesRegistry.REVISION_FILE))
+        try:
+            with open(path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _store_revision(revision: int):
+        path = pathlib.Path(inject_file_root(str(SubordinatesRegistry.REVISION_FILE)))
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            makedirs(str(SubordinatesRegistry.REVISION_FILE.parent), 0o0700)
+            tmp_path.write_text(str(revision))
+            os.replace(str(tmp_path), str(path))
+        except OSError as exc:
+            logger.warning("Failed to store revision: %r", exc)
+
+    @classmethod
+    def load(cls, backend: typing.Optional[UciBackend] = None) -> "SubordinatesRegistry":
+        """ Returns cached registry or reads a new one (using backend if provided)
+        """
+        with cls._lock:
+            stamp = cls._stamp()
+            if stamp is not None and stamp == cls._cached_stamp:
+                return cls._cached
+
+        if backend:
+            registry = cls(backend.read("fosquitto"), backend.read("foris-controller-subordinates"))
+        else:
+            with UciBackend() as new_backend:
+                registry = cls(
+                    new_backend.read("fosquitto"),
+                    new_backend.read("foris-controller-subordinates"),
                 )
-                subordinates_map[item["data"]["via"]] = subsubs
 
-        for item in get_sections_by_type(fosquitto_data, "fosquitto", "subordinate"):
-            controller_id = item["name"]
-            enabled = parse_bool(item["data"].get("enabled", "0"))
+        digest = registry.digest()
+        with cls._lock:
+            if cls._revision is None:
+                cls._revision = max(int(time.time() * 1000), cls._stored_revision())
+            if digest != cls._revision_digest:
+                records = registry.records()
+                if cls._revision_records is not None:
+                    affected = frozenset(
+                        e
+                        for e in records.keys() | cls._revision_records.keys()
+                        if records.get(e) != cls._revision_records.get(e)
+                    )
+                    cls._journal.append((cls._revision, cls._revision + 1, affected))
+                cls._revision += 1
+                cls._revision_digest = digest
+                cls._revision_records = records
+                cls._store_revision(cls._revision)
+            registry.revision = cls._revision
+            cls._cached = registry
+            cls._cached_stamp = stamp
+        return registry
+
+    @classmethod
+    def changes_since(cls, revision: int) -> dict:
+        registry = cls.load()
+        with cls._lock:
+            journal = [e for e in cls._journal if e[1] <= registry.revision]
+
+        if revision == registry.revision:
+            return {"revision": revision, "changed": [], "removed": []}
+
+        if not journal or not journal[0][0] <= revision < registry.revision:
+            # revision is unknown or it was already evicted from the journal
+            return {"resync": True, "revision": registry.revision}
+
+        affected = sorted(set().union(*[e[2] for e in journal if e[1] > revision]))
+        records = [registry.record(e) for e in affected]
+        return {
+            "revision": registry.revision,
+            "changed": [e for e in records if e],
+            "removed": [e for e, record in zip(affected, records) if not record],
+        }
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._cached = None
+            cls._cached_stamp = None
+
+    def digest(self) -> str:
+        content = [
+            self.subordinates,
+            self.subsubordinates,
+            sorted([list(k), v] for k, v in self.custom_names.items()),
+        ]
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
 
-            # try to get options
-            options = {
-                "custom_name": "",
-                "ip_address": item["data"].get("address", "0.0.0.0"),
+    def is_enabled(self, controller_id: str) -> bool:
+        if controller_id in self.subordinates:
+            return parse_bool(self.subordinates[controller_id].get("enabled", "0"))
+        return parse_bool(self.subsubordinates[controller_id].get("enabled", "1"))
+
+    def bridge_digest(self) -> str:
+        """ Digest of the configuration which affects fosquitto bridges
+
+        Options which are not used by fosquitto (e.g. custom_name) are not included.
+        """
+        digest = hashlib.sha256()
+        for controller_id in sorted(self.subordinates):
+            data = self.subordinates[controller_id]
+            record = [
+                controller_id,
+                self.is_enabled(controller_id),
+                data.get("address"),
+                data.get("port"),
+                SubordinatesFiles.bridge_stamp(controller_id),
+            ]
+            digest.update(json.dumps(record).encode())
+        for controller_id in sorted(self.subsubordinates):
+            record = [
+                controller_id,
+                self.is_enabled(controller_id),
+                self.subsubordinates[controller_id].get("via"),
+            ]
+            digest.update(json.dumps(record).encode())
+        return digest.hexdigest()
+
+    def custom_name(self, section_type: str, controller_id: str) -> str:
+        return self.custom_names.get((section_type, controller_id), "")
+
+    def subsubordinate_record(
+        self, controller_id: str, fields: typing.Optional[typing.Iterable[str]] = None
+    ) -> dict:
+        record = {"controller_id": controller_id}
+        if fields is None or "options" in fields:
+            record["options"] = {"custom_name": self.custom_name("subsubordinate", controller_id)}
+        if fields is None or "enabled" in fields:
+            record["enabled"] = self.is_enabled(controller_id)
+        return record
+
+    def subordinate_record(
+        self, controller_id: str, fields: typing.Optional[typing.Iterable[str]] = None
+    ) -> dict:
+        """ Record of a subordinate with its subsubordinates
+
+        :param fields: build only these fields (controller_id is always present), all if None
+        """
+        record = {"controller_id": controller_id}
+        if fields is None or "enabled" in fields:
+            record["enabled"] = self.is_enabled(controller_id)
+        if fields is None or "options" in fields:
+            record["options"] = {
+                "custom_name": self.custom_name("subordinate", controller_id),
+                "ip_address": self.subordinates[controller_id].get("address", "0.0.0.0"),
             }
-            options_section = self._get_options_section(sub_data, controller_id, "subordinate")
-            if options_section:
-                options["custom_name"] = options_section["data"].get("custom_name", "")
-
-            res.append(
-                {
-                    "controller_id": controller_id,
-                    "enabled": enabled,
-                    "options": options,
-                    "subsubordinates": subordinates_map.get(controller_id, []),
-                }
-            )
+        if fields is None or "subsubordinates" in fields:
+            record["subsubordinates"] = [
+                self.subsubordinate_record(e, fields) for e in self.via.get(controller_id, [])
+            ]
+        return record
 
+    def record(self, controller_id: str) -> typing.Optional[dict]:
+        """ Flat record of subordinate or subsubordinate (with via) or None if not present
+        """
+        if controller_id in self.subordinates:
+            return self.subordinate_record(controller_id, ("enabled", "options"))
+        via = self.subsubordinates.get(controller_id, {}).get("via")
+        if via in self.subordinates:
+            return dict(self.subsubordinate_record(controller_id), via=via)
+        return None
+
+    def records(self) -> typing.Dict[str, dict]:
+        res = {}
+        for controller_id in self.subordinates:
+            res[controller_id] = self.record(controller_id)
+            for subsub_id in self.via.get(controller_id, []):
+                res[subsub_id] = self.record(subsub_id)
         return res
 
+    def list(self, fields: typing.Optional[typing.Iterable[str]] = None) -> typing.List[dict]:
+        return [self.subordinate_record(e, fields) for e in self.subordinates]
+
+    def stats(self) -> dict:
+        """ Counts of records computed only from section data (cached per snapshot)
+        """
+        if self._stats is None:
+            subsubordinates = [e for via in self.subordinates for e in self.via.get(via, [])]
+            enabled_subs = sum(1 for e in self.subordinates if self.is_enabled(e))
+            enabled_subsubs = sum(1 for e in subsubordinates if self.is_enabled(e))
+            self._stats = {
+                "subordinates": {
+                    "total": len(self.subordinates),
+                    "enabled": enabled_subs,
+                    "disabled": len(self.subordinates) - enabled_subs,
+                },
+                "subsubordinates": {
+                    "total": len(subsubordinates),
+                    "enabled": enabled_subsubs,
+                    "disabled": len(subsubordinates) - enabled_subsubs,
+                },
+                "subsubordinates_per_subordinate": {
+                    e: len(self.via.get(e, [])) for e in self.subordinates
+                },
+            }
+        return self._stats
+
+    def _names_index(self) -> typing.List[typing.Tuple[str, str]]:
+        # sorted (custom_name, controller_id) of subordinates, built on the first use
+        if self._names is None:
+            self._names = sorted(
+                (self.custom_name("subordinate", e), e) for e in self.subordinates
+            )
+        return self._names
+
+    def _positions_index(self) -> typing.Dict[str, int]:
+        if self._positions is None:
+            self._positions = {e: i for i, e in enumerate(self.subordinates)}
+        return self._positions
+
+    def query(
+        self,
+        offset: int = 0,
+        limit: typing.Optional[int] = None,
+        enabled: typing.Optional[bool] = None,
+        via: typing.Optional[str] = None,
+        custom_name_prefix: typing.Optional[str] = None,
+        fields: typing.Optional[typing.Iterable[str]] = None,
+    ) -> typing.Tuple[int, typing.List[dict]]:
+        """ Filters and paginates subordinates
+
+        Only records of the returned page are built.
+
+        :param via: return only the subordinate which subsubordinates are connected via
+        :param fields: fields of the records to build (all if None)
+        :returns: (count of all matching subordinates, subordinates of the page)
+        """
+        if via is not None:
+            candidates = [via] if via in self.subordinates else []
+        elif custom_name_prefix:
+            names = self._names_index()
+            candidates = []
+            for name, controller_id in names[bisect.bisect_left(names, (custom_name_prefix,)):]:
+                if not name.startswith(custom_name_prefix):
+                    break
+                candidates.append(controller_id)
+            candidates.sort(key=self._positions_index().__getitem__)
+        else:
+            candidates = self.subordinates
+
+        matching = [
+            e
+            for e in candidates
+            if (enabled is None or self.is_enabled(e) == enabled)
+            and (
+                not custom_name_prefix
+                or self.custom_name("subordinate", e).startswith(custom_name_prefix)
+            )
+        ]
+        end = None if limit is None else offset + limit
+        return len(matching), [self.subordinate_record(e, fields) for e in matching[offset:end]]
+
+
+class SubordinatesUci(object):
+    def list_subordinates(self):
+        return SubordinatesRegistry.load().list()
+
+    def query_subordinates(
+        self,
+        if_revision: typing.Optional[int] = None,
+        fields: typing.Optional[typing.List[str]] = None,
+        **filters,
+    ) -> dict:
+        registry = SubordinatesRegistry.load()
+        if if_revision == registry.revision:
+            return {"not_modified": True, "revision": registry.revision}
+
+        fields = None if fields is None else frozenset(fields)
+        if not filters:
+            return {"subordinates": registry.list(fields), "revision": registry.revision}
+
+        total, subordinates = registry.query(fields=fields, **filters)
+        return {"subordinates": subordinates, "total": total, "revision": registry.revision}
+
+    def changes_since(self, revision: int) -> dict:
+        return SubordinatesRegistry.changes_since(revision)
+
+    def stats(self) -> dict:
+        registry = SubordinatesRegistry.load()
+        return dict(registry.stats(), revision=registry.revision)
+
+    def get_subordinate(self, controller_id: str) -> dict:
+        registry = SubordinatesRegistry.load()
+        if controller_id in registry.subordinates:
+            return {"result": True, "record": registry.subordinate_record(controller_id)}
+
+        # subsubordinate record contains via (its parent)
+        record = registry.record(controller_id)
+        return {"result": True, "record": record} if record else {"result": False}
+
     def add_subsubordinate(self, controller_id, via):
         if not app_info["bus"] == "mqtt":
             return False
 
         with subordinate_dir_lock.writelock:
-            if controller_id in self.existing_controller_ids():
-                return False
-            if via not in [e["controller_id"] for e in self.list_subordinates()]:
-                return False
-
+            SubordinatesService.track_digest()
+            # validate and write within the same session (single read + single commit)
             with UciBackend() as backend:
+                fosquitto_data = backend.read("fosquitto")
+                if controller_id in self._controller_ids(fosquitto_data):
+                    return False
+                subordinates = get_sections_by_type(fosquitto_data, "fosquitto", "subordinate")
+                if via not in {e["name"] for e in subordinates}:
+                    return False
+
                 backend.add_section("fosquitto", "subsubordinate", controller_id)
                 backend.set_option("fosquitto", controller_id, "via", via)
                 backend.set_option("fosquitto", controller_id, "enabled", store_bool(True))
+            SubordinatesRegistry.invalidate()
 
         return True
 
     @staticmethod
-    def add_subordinate(controller_id: str, address: str, port: int):
-        with UciBackend() as backend:
-            backend.add_section("fosquitto", "subordinate", controller_id)
-            backend.set_option("fosquitto", controller_id, "enabled", store_bool(True))
-            backend.set_option("fosquitto", controller_id, "address", address)
-            backend.set_option("fosquitto", controller_id, "port", port)
+    def add_subordinate(
+        controller_id: str, address: str, port: int, backend: typing.Optional[UciBackend] = None
+    ):
+        if not backend:
+            with UciBackend() as backend:
+                SubordinatesUci.add_subordinate(controller_id, address, port, backend)
+            SubordinatesRegistry.invalidate()
+            return
 
-    def set_enabled(self, controller_id: str, enabled: bool) -> bool:
-        with subordinate_dir_lock.writelock, UciBackend() as backend:
-            fosquitto_data = backend.read("fosquitto")
-            try:
-                get_section(fosquitto_data, "fosquitto", controller_id)
-            except UciRecordNotFound:
-                return False
+        backend.add_section("fosquitto", "subordinate", controller_id)
+        backend.set_option("fosquitto", controller_id, "enabled", store_bool(True))
+        backend.set_option("fosquitto", controller_id, "address", address)
+        backend.set_option("fosquitto", controller_id, "port", port)
 
-            backend.set_option("fosquitto", controller_id, "enabled", store_bool(enabled))
-        return True
+    def set_enabled(self, controller_id: str, enabled: bool) -> dict:
+        return self.set_enabled_many([controller_id], enabled)[0]
+
+    def set_enabled_many(
+        self, controller_ids: typing.List[str], enabled: bool
+    ) -> typing.List[dict]:
+        res = []
+        changed = False
+        with subordinate_dir_lock.writelock:
+            SubordinatesService.track_digest()
+            with UciBackend() as backend:
+                registry = SubordinatesRegistry.load(backend)
+                for controller_id in controller_ids:
+                    if (
+                        controller_id not in registry.subordinates
+                        and controller_id not in registry.subsubordinates
+                    ):
+                        res.append({"result": False})
+                        continue
+
+                    if registry.is_enabled(controller_id) == enabled:
+                        res.append({"result": True, "changed": False})
+                        continue
+
+                    backend.set_option(
+                        "fosquitto", controller_id, "enabled", store_bool(enabled)
+                    )
+                    res.append({"result": True, "changed": True})
+                    changed = True
+            if changed:
+                SubordinatesRegistry.invalidate()
+        return res
 
     @staticmethod
     def delete(controller_id: str) -> bool:
+        return SubordinatesUci.delete_many([controller_id])[0]
+
+    @staticmethod
+    def delete_many(controller_ids: typing.List[str]) -> typing.List[bool]:
+        res = []
         with UciBackend() as backend:
-            fosquitto_data = backend.read("fosquitto")
-            to_delete = [
-                e["name"]
-                for e in get_sections_by_type(fosquitto_data, "fosquitto", "subsubordinate")
-                if e["data"].get("via") == controller_id
-            ]
-            try:
-                backend.del_section("fosquitto", controller_id)
-                for id_to_delete in to_delete:
-                    backend.del_section("fosquitto", id_to_delete)
-            except UciException:
-                return False
+            registry = SubordinatesRegistry.load(backend)
+            deleted = set()
+            for controller_id in controller_ids:
+                if controller_id in deleted:  # already removed together with its parent
+                    res.append(True)
+                    continue
+                if (
+                    controller_id not in registry.subordinates
+                    and controller_id not in registry.subsubordinates
+                ):
+                    res.append(False)
+                    continue
 
-        return True
+                to_delete = [controller_id] + registry.via.get(controller_id, [])
+                try:
+                    for id_to_delete in to_delete:
+                        if id_to_delete not in deleted:
+                            backend.del_section("fosquitto", id_to_delete)
+                            SubordinatesUci._del_options(backend, registry, id_to_delete)
+                            deleted.add(id_to_delete)
+                except UciException:
+                    res.append(False)
+                    continue
+                res.append(True)
+        if deleted:
+            SubordinatesRegistry.invalidate()
+
+        return res
+
+    @staticmethod
+    def _del_options(backend: UciBackend, registry: SubordinatesRegistry, controller_id: str):
+        # options (custom_name) are stored in a separate config
+        if any(
+            (section_type, controller_id) in registry.custom_names
+            for section_type in ("subordinate", "subsubordinate")
+        ):
+            backend.del_section("foris-controller-subordinates", controller_id)
 
-    def existing_controller_ids(self):
-        sub_list = self.list_subordinates()
-        return (
+    @staticmethod
+    def _controller_ids(fosquitto_data: dict) -> typing.FrozenSet[str]:
+        return frozenset(
             [app_info["controller_id"]]
-            + [e["controller_id"] for e in sub_list]
-            + [e["controller_id"] for record in sub_list for e in record["subsubordinates"]]
+            + [
+                e["name"]
+                for section_type in ("subordinate", "subsubordinate")
+                for e in get_sections_by_type(fosquitto_data, "fosquitto", section_type)
+            ]
         )
 
+    def existing_controller_ids(self) -> typing.FrozenSet[str]:
+        # only section names are required here so options config is not read at all
+        with UciBackend() as backend:
+            fosquitto_data = backend.read("fosquitto")
+        return self._controller_ids(fosquitto_data)
+
     def update_sub(
         self, controller_id: str, custom_name: str, ip_address: typing.Optional[str] = None
-    ):
-        restart = False
+    ) -> dict:
+        SubordinatesService.track_digest()
         with UciBackend() as backend:
-            fosquitto_data = backend.read("fosquitto")
-            section = self._get_fosquitto_section(fosquitto_data, controller_id, "subordinate")
-            if not section:
-                return False
+            registry = SubordinatesRegistry.load(backend)
+            if controller_id not in registry.subordinates:
+                return {"result": False}
 
-            backend.add_section("foris-controller-subordinates", "subordinate", controller_id)
-            backend.set_option(
-                "foris-controller-subordinates", controller_id, "custom_name", custom_name
+            changed = self._set_custom_name(
+                backend, registry, "subordinate", controller_id, custom_name
             )
             if ip_address is not None:
-                if ip_address != section["data"]["address"]:
-                    restart = True
+                if ip_address != registry.subordinates[controller_id].get("address"):
+                    backend.set_option("fosquitto", controller_id, "address", ip_address)
+                    changed = True
 
-                backend.set_option("fosquitto", controller_id, "address", ip_address)
-        if restart:
-            SubordinatesService().restart()
+        if changed:
+            SubordinatesRegistry.invalidate()
 
-        return True
+        return {"result": True, "changed": changed}
 
-    def update_subsub(self, controller_id: str, custom_name: str):
+    def update_subsub(self, controller_id: str, custom_name: str) -> dict:
+        SubordinatesService.track_digest()
         with UciBackend() as backend:
-            fosquitto_data = backend.read("fosquitto")
-            if not self._get_fosquitto_section(fosquitto_data, controller_id, "subsubordinate"):
-                return False
-            backend.add_section("foris-controller-subordinates", "subsubordinate", controller_id)
-            backend.set_option(
-                "foris-controller-subordinates", controller_id, "custom_name", custom_name
+            registry = SubordinatesRegistry.load(backend)
+            if controller_id not in registry.subsubordinates:
+                return {"result": False}
+            changed = self._set_custom_name(
+                backend, registry, "subsubordinate", controller_id, custom_name
             )
+        if changed:
+            SubordinatesRegistry.invalidate()
+        return {"result": True, "changed": changed}
+
+    @staticmethod
+    def _set_custom_name(
+        backend: UciBackend,
+        registry: SubordinatesRegistry,
+        section_type: str,
+        controller_id: str,
+        custom_name: str,
+    ) -> bool:
+        if registry.custom_name(section_type, controller_id) == custom_name:
+            return False
+        backend.add_section("foris-controller-subordinates", section_type, controller_id)
+        backend.set_option(
+            "foris-controller-subordinates", controller_id, "custom_name", custom_name
+        )
         return True
 
+    @staticmethod
+    def sync(
+        backend: UciBackend, registry: SubordinatesRegistry, subordinates: typing.List[dict]
+    ) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        """ Apply the minimal set of changes to get to the desired state
+
+        Desired state is expected to be validated against the registry.
+
+        :returns: (affected controller_ids, removed subordinates)
+        """
+        desired_subs = {e["controller_id"]: e for e in subordinates}
+        desired_subsubs = {
+            subsub["controller_id"]: dict(subsub, via=sub["controller_id"])
+            for sub in subordinates
+            for subsub in sub["subsubordinates"]
+        }
+        affected = []
+        removed = []
+
+        # removals
+        for controller_id in registry.subsubordinates:
+            if controller_id not in desired_subsubs:
+                backend.del_section("fosquitto", controller_id)
+                SubordinatesUci._del_options(backend, registry, controller_id)
+                affected.append(controller_id)
+        for controller_id in registry.subordinates:
+            if controller_id not in desired_subs:
+                backend.del_section("fosquitto", controller_id)
+                SubordinatesUci._del_options(backend, registry, controller_id)
+                affected.append(controller_id)
+                removed.append(controller_id)
+
+        # subordinates can't be created here (a token is required)
+        for controller_id, record in desired_subs.items():
+            section = registry.subordinates[controller_id]
+            changed = False
+            if record["enabled"] != registry.is_enabled(controller_id):
+                backend.set_option(
+                    "fosquitto", controller_id, "enabled", store_bool(record["enabled"])
+                )
+                changed = True
+            ip_address = record["options"].get("ip_address")
+            if ip_address is not None and ip_address != section.get("address"):
+                backend.set_option("fosquitto", controller_id, "address", ip_address)
+                changed = True
+            if SubordinatesUci._set_custom_name(
+                backend, registry, "subordinate", controller_id, record["options"]["custom_name"]
+            ):
+                changed = True
+            if changed:
+                affected.append(controller_id)
+
+        for controller_id, record in desired_subsubs.items():
+            changed = False
+            if controller_id not in registry.subsubordinates:
+                backend.add_section("fosquitto", "subsubordinate", controller_id)
+                backend.set_option("fosquitto", controller_id, "via", record["via"])
+                backend.set_option(
+                    "fosquitto", controller_id, "enabled", store_bool(record["enabled"])
+                )
+                changed = True
+            else:
+                if record["via"] != registry.subsubordinates[controller_id].get("via"):
+                    backend.set_option("fosquitto", controller_id, "via", record["via"])
+                    changed = True
+                if record["enabled"] != registry.is_enabled(controller_id):
+                    backend.set_option(
+                        "fosquitto", controller_id, "enabled", store_bool(record["enabled"])
+                    )
+                    changed = True
+            if SubordinatesUci._set_custom_name(
+                backend,
+                registry,
+                "subsubordinate",
+                controller_id,
+                record["options"]["custom_name"],
+            ):
+                changed = True
+            if changed:
+                affected.append(controller_id)
+
+        return affected, removed
+
+
+class _Base64Reader(io.RawIOBase):
+    """ Readable binary stream which decodes base64 text chunks on demand
+    """
+
+    def __init__(self, chunks: typing.Iterable[str]):
+        self._chunks = iter(chunks)
+        self._pending = ""  # base64 characters which don't form a complete quantum yet
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> bool:
+        for chunk in self._chunks:
+            self._pending += "".join(chunk.split())
+            complete = len(self._pending) - len(self._pending) % 4
+            if complete:
+                self._buffer = base64.b64decode(self._pending[:complete], validate=True)
+                self._pending = self._pending[complete:]
+                return True
+        if self._pending:
+            raise binascii.Error("Incorrect padding")
+        return False
+
+    def readinto(self, b) -> int:
+        if not self._buffer and not self._fill():
+            return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
 
 class SubordinatesFiles(BaseFile):
+    BRIDGES_ROOT = pathlib.Path("/etc/fosquitto/bridges")
+    # digests of imported tokens: TOKENS_DIR/<digest> holds the controller id
+    # and <controller_id>/TOKEN_FILE holds the digest
+    TOKENS_DIR = ".tokens"
+    TOKEN_FILE = ".token"
+    # controller ids (as in the schema) are used as names of bridge directories
+    CONTROLLER_ID_RE = re.compile(r"[0-9a-fA-F]{16}")
+    # prefix of files and directories which are being written
+    TMP_PREFIX = ".tmp-"
+    # content addressed storage of the bridge files (see store_subordinate_files)
+    OBJECTS_ROOT = BRIDGES_ROOT / ".objects"
+    MANIFEST_FILE = ".manifest"
+    # removed bridge directories are moved here and they are removed in the background
+    TRASH_ROOT = BRIDGES_ROOT / ".trash"
+
+    _trash_lock = threading.Lock()
+    _trash_worker: typing.Optional[threading.Thread] = None
+    _trash_pending = False
+    _recovered = False
+
+    # limits of the unpacked token content
+    TOKEN_CHUNK_SIZE = 64 * 1024
+    TOKEN_MAX_MEMBERS = 32
+    TOKEN_MAX_MEMBER_SIZE = 256 * 1024
+    TOKEN_MAX_TOTAL_SIZE = 1024 * 1024
+
+    @staticmethod
+    def _bridge_path(name: str) -> pathlib.Path:
+        """ Path of the bridge directory which has to be a direct child of BRIDGES_ROOT
+
+        Hidden entries (trash, objects, ...) are refused as well.
+        """
+        root = pathlib.Path(inject_file_root(str(SubordinatesFiles.BRIDGES_ROOT)))
+        path = root / name
+        if not name or name.startswith(".") or path.parent != root:
+            raise ValueError("Invalid bridge directory name %r" % name)
+        return path
+
+    @staticmethod
+    def bridge_stamp(controller_id: str) -> typing.List[list]:
+        path = inject_file_root(str(SubordinatesFiles.BRIDGES_ROOT / controller_id))
+        res = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        res.append([entry.name, stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            pass  # missing bridge directory
+        return sorted(res)
+
+    @staticmethod
+    def token_chunks(token: typing.Union[str, pathlib.Path]) -> typing.Iterator[str]:
+        """ Reads the token text in chunks
+
+        :param token: the token itself or a path of the file where the token is stored
+        """
+        size = SubordinatesFiles.TOKEN_CHUNK_SIZE
+        if isinstance(token, str):
+            for i in range(0, len(token), size):
+                yield token[i : i + size]
+            return
+        with token.open("r", encoding="ascii") as f:
+            yield from iter(lambda: f.read(size), "")
+
     @staticmethod
-    def extract_token_subordinate(token: str) -> typing.Tuple[dict, dict]:
-        token_data = BytesIO(base64.b64decode(token))
-        with tarfile.open(fileobj=token_data, mode="r:gz") as tar:
-            config_file = [e for e in tar.getmembers() if e.name.endswith(".json")][0]
-            with tar.extractfile(config_file) as f:
-                conf = json.load(f)
-            file_data = {}
-            for member in [e for e in tar.getmembers() if e.isfile()]:
+    def extract_token_subordinate(
+        token: typing.Union[str, pathlib.Path]
+    ) -> typing.Tuple[dict, dict]:
+        """ Decodes and unpacks the token in a single pass
+
+        The tarball can be compressed using gzip, xz or bzip2 or it can be left uncompressed.
+
+        :raises ValueError: when the token content exceeds the limits or lacks the config
+        """
+        conf = None
+        file_data = {}
+        total = 0
+        chunks = SubordinatesFiles.token_chunks(token)
+        with tarfile.open(fileobj=_Base64Reader(chunks), mode="r|*") as tar:
+            for count, member in enumerate(tar, 1):
+                if count > SubordinatesFiles.TOKEN_MAX_MEMBERS:
+                    raise ValueError("Too many members in token")
+                if not member.isfile():
+                    continue
+                total += member.size
+                if member.size > SubordinatesFiles.TOKEN_MAX_MEMBER_SIZE:
+                    raise ValueError("Token member '%s' is too large" % member.name)
+                if total > SubordinatesFiles.TOKEN_MAX_TOTAL_SIZE:
+                    raise ValueError("Token content is too large")
                 with tar.extractfile(member) as f:
-                    file_data[os.path.basename(member.name)] = f.read()
+                    content = f.read()
+                file_data[os.path.basename(member.name)] = content
+                if conf is None and member.name.endswith(".json"):
+                    conf = json.loads(content)
+        if conf is None:
+            raise ValueError("Token doesn't contain config")
         return conf, file_data
 
+    @staticmethod
+    def _write_file(path: pathlib.Path, content: bytes):
+        """ Writes a new file (it is not synced here)
+        """
+        with os.fdopen(os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o0600), "wb") as f:
+            f.write(content)
+        try:  # try chown (best effort)
+            shutil.chown(path, "mosquitto", "mosquitto")
+        except (LookupError, PermissionError):
+            pass
+
+    @staticmethod
+    def _release_objects(digests: typing.Iterable[str]):
+        """ Removes stored objects which are not linked from any bridge directory
+        """
+        objects = pathlib.Path(inject_file_root(str(SubordinatesFiles.OBJECTS_ROOT)))
+        for digest in set(digests):
+            try:
+                if os.stat(str(objects / digest)).st_nlink <= 1:
+                    os.unlink(str(objects / digest))
+            except OSError:
+                pass  # already removed
+
+    @staticmethod
+    def _remove_dir(path: pathlib.Path):
+        try:
+            digests = json.loads((path / SubordinatesFiles.MANIFEST_FILE).read_text()).values()
+        except (OSError, ValueError, AttributeError):
+            digests = []  # not deduplicated
+        shutil.rmtree(str(path), ignore_errors=True)
+        if digests:
+            # objects could be linked again by an import otherwise
+            with subordinate_dir_lock.writelock:
+                SubordinatesFiles._release_objects(digests)
+
+    @staticmethod
+    def _trash(path: pathlib.Path):
+        """ Moves the directory into the trash (the caller is expected to hold the write lock)
+        """
+        makedirs(str(SubordinatesFiles.TRASH_ROOT), 0o0700)
+        trash = pathlib.Path(inject_file_root(str(SubordinatesFiles.TRASH_ROOT)))
+        try:
+            path.rename(trash / uuid.uuid4().hex)
+        except FileNotFoundError:
+            return
+        SubordinatesFiles.reclaim_trash()
+
+    @staticmethod
+    def recover():
+        """ Finishes removals which were interrupted (e.g. by a restart of the controller)
+
+        It is meant to be called when the controller starts, only the first call has an effect.
+        """
+        with SubordinatesFiles._trash_lock:
+            if SubordinatesFiles._recovered:
+                return
+            SubordinatesFiles._recovered = True
+        SubordinatesFiles.reclaim_trash()
+
+    @staticmethod
+    def reclaim_trash():
+        """ Removes the content of the trash in the background
+        """
+        with SubordinatesFiles._trash_lock:
+            SubordinatesFiles._trash_pending = True
+            if SubordinatesFiles._trash_worker is not None:
+                return  # the running worker will scan the trash again
+            worker = threading.Thread(
+                target=SubordinatesFiles._reclaim, name="subordinates-trash", daemon=True
+            )
+            SubordinatesFiles._trash_worker = worker
+        worker.start()
+
+    @staticmethod
+    def _reclaim():
+        trash = pathlib.Path(inject_file_root(str(SubordinatesFiles.TRASH_ROOT)))
+        while True:
+            with SubordinatesFiles._trash_lock:
+                if not SubordinatesFiles._trash_pending:
+                    SubordinatesFiles._trash_worker = None
+                    return
+                SubordinatesFiles._trash_pending = False
+
+            try:
+                with os.scandir(str(trash)) as entries:
+                    paths = [pathlib.Path(e.path) for e in entries]
+            except OSError:
+                paths = []  # nothing was trashed yet
+            for path in paths:
+                try:
+                    SubordinatesFiles._remove_dir(path)
+                except Exception:
+                    logger.exception("Failed to remove '%s'", path)
+
     @staticmethod
     def store_subordinate_files(controller_id: str, file_data: dict):
-        path_root = pathlib.Path("/etc/fosquitto/bridges") / controller_id
-        makedirs(str(path_root), 0o0777)
+        """ Stores the files into the bridge directory atomically
 
-        for name, content in file_data.items():
-            new_file = pathlib.Path(inject_file_root(str(path_root / name)))
-            new_file.touch(0o0600)
-            with new_file.open("wb") as f:
-                f.write(content)
-                f.flush()
+        Files are written into a temporary directory which replaces the bridge directory
+        once all the files are synced. So fosquitto never sees partially written files.
 
-            try:  # try chown (best effort)
-                shutil.chown(new_file, "mosquitto", "mosquitto")
-            except (LookupError, PermissionError):
-                pass
+        The content of the files is stored only once in OBJECTS_ROOT (named by its sha256)
+        and it is hardlinked into the bridge directories. MANIFEST_FILE of the bridge directory
+        contains the names of the linked objects.
+        """
+        new_objects = {}
+        tmp_path = SubordinatesFiles.stage_subordinate_files(controller_id, file_data, new_objects)
+        if SubordinatesFiles.publish_subordinate_files({controller_id: tmp_path}, new_objects):
+            raise OSError("Failed to store files of '%s'" % controller_id)
+
+    @staticmethod
+    def stage_subordinate_files(
+        controller_id: str, file_data: dict, new_objects: typing.Dict[str, pathlib.Path]
+    ) -> pathlib.Path:
+        """ Writes the files of the bridge directory without syncing and publishing them
+
+        Several bridge directories can be staged and published together by
+        publish_subordinate_files (so the files are synced only once).
+
+        :param new_objects: objects which are staged (digest -> temporary path), it is
+                            updated and shared by all the bridge directories of the batch
+        :returns: temporary path of the bridge directory
+        """
+        # controller id (from the token) must not point outside of the bridges root
+        if not SubordinatesFiles.CONTROLLER_ID_RE.fullmatch(controller_id):
+            raise ValueError("Invalid controller id %r" % controller_id)
+        root = SubordinatesFiles._bridge_path(controller_id).parent
+
+        makedirs(str(SubordinatesFiles.OBJECTS_ROOT), 0o0700)
+        objects = pathlib.Path(inject_file_root(str(SubordinatesFiles.OBJECTS_ROOT)))
+        tmp_path = root / (SubordinatesFiles.TMP_PREFIX + uuid.uuid4().hex)
+        tmp_path.mkdir(0o0777)
+
+        manifest = {}
+        created = []
+        try:
+            for name, content in file_data.items():
+                digest = hashlib.sha256(content).hexdigest()
+                manifest[name] = digest
+                if digest not in new_objects and not (objects / digest).exists():
+                    new_objects[digest] = objects / (SubordinatesFiles.TMP_PREFIX + digest)
+                    created.append(digest)
+                    SubordinatesFiles._write_file(new_objects[digest], content)
+
+            for name, digest in manifest.items():
+                try:
+                    os.link(str(new_objects.get(digest, objects / digest)), str(tmp_path / name))
+                except OSError:  # hardlinks are not supported
+                    SubordinatesFiles._write_file(tmp_path / name, file_data[name])
+            SubordinatesFiles._write_file(
+                tmp_path / SubordinatesFiles.MANIFEST_FILE, json.dumps(manifest).encode()
+            )
+        except BaseException:
+            shutil.rmtree(str(tmp_path), ignore_errors=True)
+            for digest in created:
+                object_path = new_objects.pop(digest)
+                if object_path.exists():
+                    object_path.unlink()
+            SubordinatesFiles._release_objects(manifest.values())
+            raise
+
+        return tmp_path
+
+    @staticmethod
+    def publish_subordinate_files(
+        staged: typing.Dict[str, pathlib.Path], new_objects: typing.Dict[str, pathlib.Path]
+    ) -> typing.List[str]:
+        """ Syncs the staged bridge directories at once and moves them into place
+
+        :param staged: controller_id -> temporary path (see stage_subordinate_files)
+        :param new_objects: objects of all the staged bridge directories
+        :returns: controller ids which failed to be published
+        """
+        objects = pathlib.Path(inject_file_root(str(SubordinatesFiles.OBJECTS_ROOT)))
+        failed = []
+        try:
+            # a single sync of everything written so far before any of it is published
+            os.sync()
+            for digest, object_path in new_objects.items():
+                object_path.rename(objects / digest)
+        except OSError as exc:
+            logger.warning("Failed to store bridge files: %r", exc)
+            failed = list(staged)
+
+        for controller_id, tmp_path in staged.items():
+            if controller_id not in failed:
+                try:
+                    path = SubordinatesFiles._bridge_path(controller_id)
+                    if path.exists():
+                        # stale directory (e.g. a leftover of a failed import)
+                        SubordinatesFiles._trash(path)
+                    tmp_path.rename(path)
+                    continue
+                except (OSError, ValueError) as exc:
+                    logger.warning("Failed to publish files of '%s': %r", controller_id, exc)
+                    failed.append(controller_id)
+            shutil.rmtree(str(tmp_path), ignore_errors=True)
+
+        # objects which are not linked at all (e.g. when hardlinks are not supported)
+        SubordinatesFiles._release_objects(new_objects)
+        for object_path in new_objects.values():
+            if object_path.exists():
+                object_path.unlink()  # not renamed
+        return failed
+
+    @staticmethod
+    def token_digest(token: typing.Union[str, pathlib.Path]) -> str:
+        digest = hashlib.sha256()
+        for chunk in SubordinatesFiles.token_chunks(token):
+            digest.update("".join(chunk.split()).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def token_controller_id(digest: str) -> typing.Optional[str]:
+        """ Controller id of stored files which were imported from the token with the digest
+        """
+        root = pathlib.Path(inject_file_root(str(SubordinatesFiles.BRIDGES_ROOT)))
+        try:
+            controller_id = (root / SubordinatesFiles.TOKENS_DIR / digest).read_text().strip()
+            path = SubordinatesFiles._bridge_path(controller_id)
+            stored = (path / SubordinatesFiles.TOKEN_FILE).read_text().strip()
+        except (OSError, ValueError):
+            return None
+        return controller_id if controller_id and stored == digest else None
+
+    @staticmethod
+    def store_token_digest(controller_id: str, digest: str):
+        """ Indexes the digest (the bridge directory has to contain TOKEN_FILE already)
+        """
+        makedirs(str(SubordinatesFiles.BRIDGES_ROOT / SubordinatesFiles.TOKENS_DIR), 0o0700)
+        root = pathlib.Path(inject_file_root(str(SubordinatesFiles.BRIDGES_ROOT)))
+        (root / SubordinatesFiles.TOKENS_DIR / digest).write_text(controller_id)
+
+    @staticmethod
+    def scan() -> dict:
+        """ Scans the bridges root (each directory is read only once)
+
+        :returns: {"bridges": controller ids of bridge directories, "temporary": paths
+                  of interrupted writes, "orphan_tokens": paths, "orphan_objects": paths}
+        """
+        res = {"bridges": set(), "temporary": [], "orphan_tokens": [], "orphan_objects": []}
+        root = pathlib.Path(inject_file_root(str(SubordinatesFiles.BRIDGES_ROOT)))
+        try:
+            with os.scandir(str(root)) as entries:
+                for entry in entries:
+                    if entry.name.startswith(SubordinatesFiles.TMP_PREFIX):
+                        res["temporary"].append(pathlib.Path(entry.path))
+                    elif not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False):
+                        res["bridges"].add(entry.name)
+        except OSError:
+            return res  # no bridges at all
+
+        try:
+            with os.scandir(str(root / SubordinatesFiles.TOKENS_DIR)) as entries:
+                for entry in entries:
+                    if SubordinatesFiles.token_controller_id(entry.name) is None:
+                        res["orphan_tokens"].append(pathlib.Path(entry.path))
+        except OSError:
+            pass  # no tokens
+
+        objects = pathlib.Path(inject_file_root(str(SubordinatesFiles.OBJECTS_ROOT)))
+        try:
+            with os.scandir(str(objects)) as entries:
+                for entry in entries:
+                    if (
+                        entry.name.startswith(SubordinatesFiles.TMP_PREFIX)
+                        or entry.stat(follow_symlinks=False).st_nlink <= 1
+                    ):
+                        res["orphan_objects"].append(pathlib.Path(entry.path))
+        except OSError:
+            pass  # no objects
+
+        return res
 
     @staticmethod
     def remove_subordinate(controller_id: str):
-        path = pathlib.Path("/etc/fosquitto/bridges") / controller_id
-        shutil.rmtree(inject_file_root(str(path)), ignore_errors=True)
+        path = SubordinatesFiles._bridge_path(controller_id)
+        try:
+            digest = (path / SubordinatesFiles.TOKEN_FILE).read_text().strip()
+            (path.parent / SubordinatesFiles.TOKENS_DIR / digest).unlink()
+        except (OSError, ValueError):
+            pass  # not imported from a token or already removed
+        SubordinatesFiles._trash(path)
 
 
 class SubordinatesComplex:
-    def add_subordinate(self, token):
-        if not app_info["bus"] == "mqtt":
+    @staticmethod
+    def _guess_ip(conf: dict) -> str:
+        # it would be more common to use wan ip first
+        if conf["ipv4_ips"].get("wan", None):
+            return conf["ipv4_ips"]["wan"][0]
+        elif conf["ipv4_ips"].get("lan", None):
+            return conf["ipv4_ips"]["lan"][0]
+        return ""
+
+    @staticmethod
+    def _imported(digests: typing.List[str]) -> typing.List[typing.Optional[dict]]:
+        """ Results of tokens which were already imported (None for the others)
+
+        Neither the tokens are extracted nor anything is written here.
+        """
+        with subordinate_dir_lock.readlock:
+            controller_ids = [SubordinatesFiles.token_controller_id(e) for e in digests]
+            if not any(controller_ids):
+                return [None for _ in digests]
+            existing_ids = SubordinatesUci().existing_controller_ids()
+        return [
+            {"result": True, "controller_id": e, "changed": False} if e in existing_ids else None
+            for e in controller_ids
+        ]
+
+    @staticmethod
+    def _parse_token(
+        token: typing.Union[str, pathlib.Path]
+    ) -> typing.Optional[typing.Tuple[dict, dict]]:
+        try:
+            conf, file_data = SubordinatesFiles.extract_token_subordinate(token)
+        except (tarfile.TarError, ValueError, LookupError, EOFError) as exc:
+            logger.warning("Failed to extract subordinate token: %r", exc)
+            return None
+
+        # incomplete or malformed tokens are refused before anything is written
+        if not SubordinatesComplex._valid_conf(conf):
+            logger.warning("Subordinate token is missing required fields or they are malformed")
+            return None
+
+        return conf, file_data
+
+    @staticmethod
+    def _valid_conf(conf) -> bool:
+        if not isinstance(conf, dict) or not all(
+            key in conf for key in ("device_id", "port", "ipv4_ips")
+        ):
+            return False
+        device_id = conf["device_id"]
+        if not isinstance(device_id, str) or not SubordinatesFiles.CONTROLLER_ID_RE.fullmatch(
+            device_id
+        ):
+            return False
+        if not isinstance(conf["port"], int) or isinstance(conf["port"], bool):
+            return False
+        if not isinstance(conf["ipv4_ips"], dict):
+            return False
+        return all(
+            isinstance(ips, list) and all(isinstance(e, str) for e in ips)
+            for ips in conf["ipv4_ips"].values()
+        )
+
+    def inspect_token(self, token: str) -> dict:
+        """ Parses the token without importing it (no lock is taken and nothing is written)
+        """
+        parsed = self._parse_token(token)
+        if not parsed:
             return {"result": False}
+        conf, file_data = parsed
+
+        return {
+            "result": True,
+            "controller_id": conf["device_id"],
+            "ipv4_ips": {e: list(conf["ipv4_ips"].get(e) or []) for e in ("lan", "wan")},
+            "port": conf["port"],
+            "files": sorted(file_data),
+            "exists": conf["device_id"] in SubordinatesUci().existing_controller_ids(),
+        }
+
+    def fsck(self, repair: bool = False) -> dict:
+        """ Finds (and optionally repairs) inconsistencies between uci and the bridge files
+
+        Missing bridge directories are only reported (the files can't be restored).
+        """
+        lock = subordinate_dir_lock.writelock if repair else subordinate_dir_lock.readlock
+        with lock:
+            if repair:
+                SubordinatesService.track_digest()
+            with UciBackend() as backend:
+                registry = SubordinatesRegistry.load(backend)
+                files = SubordinatesFiles.scan()
+
+                orphan_subsubs = [
+                    e
+                    for e, data in registry.subsubordinates.items()
+                    if data.get("via") not in registry.subordinates
+                ]
+                sections = {
+                    "subordinate": registry.subordinates,
+                    "subsubordinate": registry.subsubordinates,
+                }
+                orphan_options = [
+                    controller_id
+                    for section_type, controller_id in registry.custom_names
+                    if controller_id not in sections[section_type]
+                ]
+                if repair:
+                    for controller_id in orphan_subsubs:
+                        backend.del_section("fosquitto", controller_id)
+                    for controller_id in orphan_options:
+                        backend.del_section("foris-controller-subordinates", controller_id)
+
+            orphan_dirs = sorted(files["bridges"].difference(registry.subordinates))
+            if repair:
+                if orphan_subsubs or orphan_options:
+                    SubordinatesRegistry.invalidate()
+                for controller_id in orphan_dirs:
+                    SubordinatesFiles.remove_subordinate(controller_id)
+                for path in files["temporary"]:
+                    SubordinatesFiles._trash(path)
+                for path in files["orphan_tokens"] + files["orphan_objects"]:
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass  # already removed
 
-        conf, file_data = SubordinatesFiles.extract_token_subordinate(token)
+        return {
+            "orphan_bridge_dirs": orphan_dirs,
+            "missing_bridge_dirs": [e for e in registry.subordinates if e not in files["bridges"]],
+            "orphan_subsubordinates": orphan_subsubs,
+            "orphan_options": sorted(set(orphan_options)),
+            "orphan_tokens": len(files["orphan_tokens"]),
+            "orphan_objects": len(files["orphan_objects"]),
+            "temporary": len(files["temporary"]),
+            "repaired": repair,
+        }
 
+    def add_subordinate(self, token: typing.Union[str, pathlib.Path]) -> dict:
+        return self.add_subordinates([token])[0]
+
+    def add_subordinates(
+        self, tokens: typing.List[typing.Union[str, pathlib.Path]]
+    ) -> typing.List[dict]:
+        if not app_info["bus"] == "mqtt":
+            return [{"result": False} for _ in tokens]
+
+        digests = [SubordinatesFiles.token_digest(token) for token in tokens]
+        res = self._imported(digests)
+        # the same token passed several times is imported only once
+        first = {}
+        for i, digest in enumerate(digests):
+            first.setdefault(digest, i)
+        pending = [i for i, e in enumerate(res) if e is None and first[digests[i]] == i]
+        if not pending:
+            return res
+
+        extracted = {i: self._parse_token(tokens[i]) for i in pending}
+
+        # all the tokens are imported within a single lock, a single sync of the files
+        # and a single uci commit
         with subordinate_dir_lock.writelock:
+            SubordinatesService.track_digest()
+            with UciBackend() as backend:
+                existing_ids = set(SubordinatesUci._controller_ids(backend.read("fosquitto")))
 
-            if conf["device_id"] in SubordinatesUci().existing_controller_ids():
-                return {"result": False}
+                new_objects = {}
+                staged = {}  # index of the token -> temporary path of its bridge directory
+                for i in pending:
+                    if not extracted[i]:
+                        res[i] = {"result": False}
+                        continue
+                    conf, file_data = extracted[i]
+                    if conf["device_id"] in existing_ids:
+                        if SubordinatesFiles.token_controller_id(digests[i]) == conf["device_id"]:
+                            # the same token was already imported
+                            res[i] = {
+                                "result": True,
+                                "controller_id": conf["device_id"],
+                                "changed": False,
+                            }
+                        else:
+                            res[i] = {"result": False}
+                        continue
+                    try:
+                        staged[i] = SubordinatesFiles.stage_subordinate_files(
+                            conf["device_id"],
+                            dict(file_data, **{SubordinatesFiles.TOKEN_FILE: digests[i].encode()}),
+                            new_objects,
+                        )
+                    except (OSError, ValueError) as exc:
+                        # a single broken token should not abort the whole batch
+                        logger.warning("Failed to import subordinate token: %r", exc)
+                        res[i] = {"result": False}
+                        continue
+                    existing_ids.add(conf["device_id"])
 
-            SubordinatesFiles.store_subordinate_files(conf["device_id"], file_data)
+                failed = SubordinatesFiles.publish_subordinate_files(
+                    {extracted[i][0]["device_id"]: path for i, path in staged.items()}, new_objects
+                )
 
-            guessed_ip = ""
-            # it would be more common to use wan ip first
-            if conf["ipv4_ips"].get("wan", None):
-                guessed_ip = conf["ipv4_ips"]["wan"][0]
-            elif conf["ipv4_ips"].get("lan", None):
-                guessed_ip = conf["ipv4_ips"]["lan"][0]
+                for i in staged:
+                    conf = extracted[i][0]
+                    res[i] = {"result": False}
+                    if conf["device_id"] in failed:
+                        continue
+                    try:
+                        SubordinatesFiles.store_token_digest(conf["device_id"], digests[i])
+                        SubordinatesUci.add_subordinate(
+                            conf["device_id"], self._guess_ip(conf), conf["port"], backend
+                        )
+                    except (OSError, UciException) as exc:
+                        logger.warning("Failed to import subordinate token: %r", exc)
+                        # bridge files should not outlive a failed import
+                        SubordinatesFiles.remove_subordinate(conf["device_id"])
+                        continue
+                    res[i] = {"result": True, "controller_id": conf["device_id"], "changed": True}
+            SubordinatesRegistry.invalidate()
 
-            SubordinatesUci.add_subordinate(conf["device_id"], guessed_ip, conf["port"])
+        for i, digest in enumerate(digests):
+            if res[i] is None:
+                # repeated token
+                res[i] = dict(res[first[digest]])
+                if res[i]["result"]:
+                    res[i]["changed"] = False
 
-        return {"result": True, "controller_id": conf["device_id"]}
+        return res
+
+    def sync(self, subordinates: typing.List[dict]) -> dict:
+        if not app_info["bus"] == "mqtt":
+            return {"result": False, "missing": []}
+
+        subsub_ids = [e["controller_id"] for sub in subordinates for e in sub["subsubordinates"]]
+        all_ids = [e["controller_id"] for e in subordinates] + subsub_ids
+        if len(set(all_ids)) != len(all_ids) or app_info["controller_id"] in all_ids:
+            return {"result": False, "missing": []}
+
+        with subordinate_dir_lock.writelock:
+            SubordinatesService.track_digest()
+            with UciBackend() as backend:
+                registry = SubordinatesRegistry.load(backend)
+                missing = [
+                    e["controller_id"]
+                    for e in subordinates
+                    if e["controller_id"] not in registry.subordinates
+                ]
+                if missing or any(e in registry.subordinates for e in subsub_ids):
+                    return {"result": False, "missing": missing}
+
+                affected, removed = SubordinatesUci.sync(backend, registry, subordinates)
+            if affected:
+                SubordinatesRegistry.invalidate()
+
+            for controller_id in removed:
+                SubordinatesFiles.remove_subordinate(controller_id)
+
+        return {"result": True, "controller_ids": affected}
 
     def delete(self, controller_id):
+        return self.delete_many([controller_id])[0]
+
+    def delete_many(self, controller_ids: typing.List[str]) -> typing.List[bool]:
         with subordinate_dir_lock.writelock:
-            if not SubordinatesUci.delete(controller_id):
+            SubordinatesService.track_digest()
+            res = SubordinatesUci.delete_many(controller_ids)
+            for controller_id, deleted in zip(controller_ids, res):
+                if deleted:
+                    SubordinatesFiles.remove_subordinate(controller_id)
+
+        return res
+
+
+class SubordinatesUploads:
+    """ Tokens uploaded in chunks are spooled into files and imported from there
+    """
+
+    SPOOL_DIR = pathlib.Path("/tmp/foris-controller-subordinates-uploads")
+    MAX_UPLOADS = 16
+    MAX_SIZE = 2 * 1024 * 1024  # of the base64 encoded token
+    EXPIRE = 600.0  # unfinished uploads are removed after this time (in seconds)
+
+    _lock = threading.Lock()
+
+    def __init__(self, subordinates_complex: SubordinatesComplex):
+        # uploaded tokens are imported the same way as the tokens of add_sub
+        self.complex = subordinates_complex
+
+    @staticmethod
+    def _path(upload_id: str) -> pathlib.Path:
+        return pathlib.Path(inject_file_root(str(SubordinatesUploads.SPOOL_DIR / upload_id)))
+
+    @staticmethod
+    def _sweep() -> int:
+        """ Removes expired uploads
+
+        :returns: count of remaining uploads
+        """
+        remaining = 0
+        expired = time.time() - SubordinatesUploads.EXPIRE
+        with os.scandir(inject_file_root(str(SubordinatesUploads.SPOOL_DIR))) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < expired:
+                        os.unlink(entry.path)
+                    else:
+                        remaining += 1
+                except OSError:
+                    pass  # removed concurrently
+        return remaining
+
+    def begin(self) -> dict:
+        makedirs(str(SubordinatesUploads.SPOOL_DIR), 0o0700)
+        with SubordinatesUploads._lock:
+            if self._sweep() >= SubordinatesUploads.MAX_UPLOADS:
+                logger.warning("Too many unfinished token uploads")
+                return {"result": False}
+            upload_id = uuid.uuid4().hex
+            self._path(upload_id).touch(0o0600, exist_ok=False)
+        return {"result": True, "upload_id": upload_id}
+
+    def chunk(self, upload_id: str, offset: int, data: str) -> dict:
+        """ Appends the chunk to the upload
+
+        Chunks which don't start at the current end of the upload are refused
+        and the current size is returned so the client can resume.
+        """
+        try:
+            content = data.encode("ascii")
+        except UnicodeEncodeError:
+            return {"result": False}
+
+        path = self._path(upload_id)
+        with SubordinatesUploads._lock:
+            try:
+                size = path.stat().st_size
+            except OSError:
+                return {"result": False}
+            if offset != size:
+                return {"result": False, "size": size}
+            if size + len(content) > SubordinatesUploads.MAX_SIZE:
+                logger.warning("Token upload '%s' is too large", upload_id)
+                path.unlink()
+                return {"result": False}
+            with path.open("ab") as f:
+                f.write(content)
+        return {"result": True, "size": size + len(content)}
+
+    def commit(self, upload_id: str) -> dict:
+        path = self._path(upload_id)
+        if not path.exists():
+            return {"result": False}
+        try:
+            return self.complex.add_subordinate(path)
+        finally:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+class SubordinatesService:
+    # restart requests within this window (in seconds) are coalesced into a single restart
+    # (it can be overridden by option restart_delay of section settings of
+    # foris-controller-subordinates config)
+    RESTART_DELAY = 1.0
+
+    _lock = threading.Lock()
+    # held during the restart itself so the restarts never overlap
+    _restart_lock = threading.Lock()
+    _timer: typing.Optional[threading.Timer] = None
+    _callbacks: typing.List[typing.Callable[[bool], None]] = []
+    # digest of the bridge configuration which is used by the running broker
+    _applied_digest: typing.Optional[str] = None
+
+    @staticmethod
+    def track_digest():
+        """ Remembers the digest of the bridge configuration before it is changed for the first time
+        """
+        with SubordinatesService._lock:
+            if SubordinatesService._applied_digest is not None:
+                return
+
+        digest = SubordinatesRegistry.load().bridge_digest()
+        with SubordinatesService._lock:
+            if SubordinatesService._applied_digest is None:
+                SubordinatesService._applied_digest = digest
+
+    def restart(self, callback: typing.Optional[typing.Callable[[bool], None]] = None) -> bool:
+        """ Schedules fosquitto restart which is performed in the background
+
+        Restart is scheduled only when the effective bridge configuration was changed.
+
+        :param callback: called with the result once the broker is restarted
+        :returns: True if restart was scheduled False otherwise
+        """
+        registry = SubordinatesRegistry.load()
+        digest = registry.bridge_digest()
+        delay = self.RESTART_DELAY if registry.restart_delay is None else registry.restart_delay
+        with SubordinatesService._lock:
+            if (
+                SubordinatesService._timer is None
+                and digest == SubordinatesService._applied_digest
+            ):
                 return False
-            SubordinatesFiles.remove_subordinate(controller_id)
+
+            # the same callback is notified only once per restart
+            if callback and callback not in SubordinatesService._callbacks:
+                SubordinatesService._callbacks.append(callback)
+            if SubordinatesService._timer is None:
+                timer = threading.Timer(delay, SubordinatesService._restart)
+                timer.daemon = True
+                timer.start()
+                SubordinatesService._timer = timer
 
         return True
 
+    @staticmethod
+    def _restart():
+        with SubordinatesService._lock:
+            # requests which arrive from now on will trigger another restart
+            SubordinatesService._timer = None
+            callbacks = SubordinatesService._callbacks
+            SubordinatesService._callbacks = []
+
+        with SubordinatesService._restart_lock:
+            try:
+                digest = SubordinatesRegistry.load().bridge_digest()
+                with SubordinatesService._lock:
+                    # already applied by the restart which was running meanwhile
+                    skip = digest == SubordinatesService._applied_digest
+                if not skip:
+                    with OpenwrtServices() as services:
+                        services.restart("fosquitto")
+                    with SubordinatesService._lock:
+                        SubordinatesService._applied_digest = digest
+                result = True
+            except Exception:
+                logger.exception("Failed to restart fosquitto")
+                result = False
 
-class SubordinatesService:
-    def restart(self):
-        with OpenwrtServices() as services:
-            services.restart("fosquitto")
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception:
+                logger.exception("Restart callback failed")
@@ -26,60 +26,152 @@ from foris_controller.handler_base import wrap_required_functions
 class SubordinatesModule(BaseModule):
     logger = logging.getLogger(__name__)
 
+    def _mqtt_restarted(self, result: bool):
+        self.notify("restarted", {"result": result})
+
     def action_list(self, data):
-        return {"subordinates": self.handler.list_subordinates()}
+        return self.handler.query_subordinates(**(data or {}))
 
-    def action_add_sub(self, data):
-        res = self.handler.add_sub(**data)
-        if res["result"]:
+    def action_get(self, data):
+        return self.handler.get_subordinate(**data)
+
+    def action_stats(self, data):
+        return self.handler.stats()
+
+    def action_changes_since(self, data):
+        return self.handler.changes_since(**data)
+
+    def action_inspect_token(self, data):
+        return self.handler.inspect_token(**data)
+
+    def _sub_added(self, res: dict):
+        if res["result"] and res["changed"]:
             self.notify(
                 "add_sub",
                 {"controller_id": res["controller_id"]}
             )
-            self.handler.restart_mqtt()
+            self.handler.restart_mqtt(self._mqtt_restarted)
+
+    def action_add_sub(self, data):
+        res = self.handler.add_sub(**data)
+        self._sub_added(res)
         return res
 
+    def action_token_upload_begin(self, data):
+        return self.handler.token_upload_begin()
+
+    def action_token_upload_chunk(self, data):
+        return self.handler.token_upload_chunk(**data)
+
+    def action_token_upload_commit(self, data):
+        res = self.handler.token_upload_commit(**data)
+        self._sub_added(res)
+        return res
+
+    def action_add_subs(self, data):
+        results = self.handler.add_subs(**data)
+        controller_ids = [e["controller_id"] for e in results if e["result"] and e["changed"]]
+        if controller_ids:
+            self.notify("add_subs", {"controller_ids": controller_ids})
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return {"results": results}
+
     def action_add_subsub(self, data):
         res = self.handler.add_subsub(**data)
         if res:
             self.notify("add_subsub", data)
-            self.handler.restart_mqtt()
+            self.handler.restart_mqtt(self._mqtt_restarted)
         return {"result": res}
 
     def action_del(self, data):
         res = self.handler.delete(**data)
         if res:
             self.notify("del", data)
-            self.handler.restart_mqtt()
+            self.handler.restart_mqtt(self._mqtt_restarted)
         return {"result": res}
 
+    def action_del_many(self, data):
+        res = self.handler.delete_many(**data)
+        deleted = [e for e, result in zip(data["controller_ids"], res) if result]
+        if deleted:
+            self.notify("del_many", {"controller_ids": deleted})
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return {
+            "results": [
+                {"controller_id": e, "result": result}
+                for e, result in zip(data["controller_ids"], res)
+            ]
+        }
+
     def action_set_enabled(self, data):
         res = self.handler.set_enabled(**data)
-        if res:
+        if res["result"] and res["changed"]:
             self.notify("set_enabled", data)
-            self.handler.restart_mqtt()
-        return {"result": res}
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return res
+
+    def action_set_enabled_many(self, data):
+        res = self.handler.set_enabled_many(**data)
+        updated = [
+            e for e, result in zip(data["controller_ids"], res) if result.get("changed", False)
+        ]
+        if updated:
+            self.notify("set_enabled_many", {"controller_ids": updated, "enabled": data["enabled"]})
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return {
+            "results": [
+                dict(result, controller_id=e) for e, result in zip(data["controller_ids"], res)
+            ]
+        }
+
+    def action_sync(self, data):
+        res = self.handler.sync(**data)
+        if res["result"] and res["controller_ids"]:
+            self.notify("sync", {"controller_ids": res["controller_ids"]})
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return res
+
+    def action_fsck(self, data):
+        res = self.handler.fsck(**(data or {}))
+        if res["repaired"] and res["orphan_subsubordinates"]:
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return res
 
     def action_update_sub(self, data):
         res = self.handler.update_sub(data["controller_id"], **data["options"])
-        if res:
+        if res["result"] and res["changed"]:
             self.notify("update_sub", data)
-        return {"result": res}
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return res
 
     def action_update_subsub(self, data):
         res = self.handler.update_subsub(data["controller_id"], **data["options"])
-        if res:
+        if res["result"] and res["changed"]:
             self.notify("update_subsub", data)
-        return {"result": res}
+            self.handler.restart_mqtt(self._mqtt_restarted)
+        return res
 
 
 @wrap_required_functions([
     'list_subordinates',
+    'query_subordinates',
+    'changes_since',
+    'get_subordinate',
+    'stats',
+    'inspect_token',
     'add_sub',
+    'token_upload_begin',
+    'token_upload_chunk',
+    'token_upload_commit',
+    'add_subs',
     'add_subsub',
     'delete',
+    'delete_many',
     'set_enabled',
+    'set_enabled_many',
     'restart_mqtt',
+    'fsck',
+    'sync',
     'update_sub',
     'update_subsub',
 ])
@@ -22,6 +22,7 @@ import logging
 import base64
 import tarfile
 import typing
+import uuid
 
 from io import BytesIO
 
@@ -36,6 +37,37 @@ logger = logging.getLogger(__name__)
 
 class MockSubordinatesHandler(Handler, BaseMockHandler):
     subordinates: typing.List[dict] = []
+    revision: int = 1
+    revision_records: typing.Dict[str, dict] = {}
+    tokens: typing.Dict[str, str] = {}  # imported token -> controller_id
+    uploads: typing.Dict[str, str] = {}
+    journal: typing.List[typing.Tuple[int, int, typing.Set[str]]] = []
+
+    def _records(self) -> typing.Dict[str, dict]:
+        res = {}
+        for record in self.list_subordinates():
+            res[record["controller_id"]] = {
+                k: v for k, v in record.items() if k != "subsubordinates"
+            }
+            for subsub in record["subsubordinates"]:
+                res[subsub["controller_id"]] = dict(subsub, via=record["controller_id"])
+        return json.loads(json.dumps(res))  # deep copy
+
+    def _revision(self) -> int:
+        records = self._records()
+        if records != MockSubordinatesHandler.revision_records:
+            affected = {
+                e
+                for e in set(records) | set(MockSubordinatesHandler.revision_records)
+                if records.get(e) != MockSubordinatesHandler.revision_records.get(e)
+            }
+            MockSubordinatesHandler.journal.append(
+                (MockSubordinatesHandler.revision, MockSubordinatesHandler.revision + 1, affected)
+            )
+            del MockSubordinatesHandler.journal[:-256]
+            MockSubordinatesHandler.revision += 1
+            MockSubordinatesHandler.revision_records = records
+        return MockSubordinatesHandler.revision
 
     @logger_wrapper(logger)
     def list_subordinates(self):
@@ -43,13 +75,135 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
             return []
         return MockSubordinatesHandler.subordinates
 
+    @logger_wrapper(logger)
+    def query_subordinates(
+        self,
+        if_revision: typing.Optional[int] = None,
+        fields: typing.Optional[typing.List[str]] = None,
+        **filters,
+    ) -> dict:
+        revision = self._revision()
+
+        if if_revision == revision:
+            return {"not_modified": True, "revision": revision}
+        if fields is not None:
+            reply = self.query_subordinates(**filters)
+            reply["subordinates"] = [
+                self._project(e, ["controller_id"] + fields) for e in reply["subordinates"]
+            ]
+            return reply
+        if not filters:
+            return {"subordinates": self.list_subordinates(), "revision": revision}
+
+        matching = [
+            e
+            for e in self.list_subordinates()
+            if filters.get("enabled") in (None, e["enabled"])
+            and filters.get("via") in (None, e["controller_id"])
+            and e["options"]["custom_name"].startswith(filters.get("custom_name_prefix", ""))
+        ]
+        offset = filters.get("offset", 0)
+        end = None if filters.get("limit") is None else offset + filters["limit"]
+        return {"subordinates": matching[offset:end], "total": len(matching), "revision": revision}
+
+    @staticmethod
+    def _project(record: dict, fields: typing.List[str]) -> dict:
+        res = {k: v for k, v in record.items() if k in fields}
+        if "subsubordinates" in res:
+            res["subsubordinates"] = [
+                {k: v for k, v in e.items() if k in fields} for e in res["subsubordinates"]
+            ]
+        return res
+
+    @logger_wrapper(logger)
+    def changes_since(self, revision: int) -> dict:
+        current = self._revision()
+        if revision == current:
+            return {"revision": revision, "changed": [], "removed": []}
+
+        journal = MockSubordinatesHandler.journal
+        if not journal or not journal[0][0] <= revision < current:
+            return {"resync": True, "revision": current}
+
+        affected = sorted(set().union(*[e[2] for e in journal if e[1] > revision]))
+        records = MockSubordinatesHandler.revision_records
+        return {
+            "revision": current,
+            "changed": [records[e] for e in affected if e in records],
+            "removed": [e for e in affected if e not in records],
+        }
+
+    @logger_wrapper(logger)
+    def get_subordinate(self, controller_id: str) -> dict:
+        for record in self.list_subordinates():
+            if record["controller_id"] == controller_id:
+                return {"result": True, "record": record}
+            for subsub in record["subsubordinates"]:
+                if subsub["controller_id"] == controller_id:
+                    return {
+                        "result": True,
+                        "record": dict(subsub, via=record["controller_id"]),
+                    }
+        return {"result": False}
+
+    @logger_wrapper(logger)
+    def stats(self) -> dict:
+        def counts(records):
+            enabled = len([e for e in records if e["enabled"]])
+            return {"total": len(records), "enabled": enabled, "disabled": len(records) - enabled}
+
+        subordinates = self.list_subordinates()
+        return {
+            "subordinates": counts(subordinates),
+            "subsubordinates": counts([e for r in subordinates for e in r["subsubordinates"]]),
+            "subsubordinates_per_subordinate": {
+                e["controller_id"]: len(e["subsubordinates"]) for e in subordinates
+            },
+            "revision": self._revision(),
+        }
+
+    @logger_wrapper(logger)
+    def inspect_token(self, token) -> dict:
+        try:
+            token_data = BytesIO(base64.b64decode(token))
+            with tarfile.open(fileobj=token_data, mode="r:*") as tar:
+                files = sorted(e.name.split("/")[-1] for e in tar.getmembers() if e.isfile())
+                config_name = [e for e in tar.getmembers() if e.name.endswith("conf.json")][0]
+                with tar.extractfile(config_name) as f:
+                    device_data = json.load(f)
+            controller_id = device_data["device_id"]
+            port = device_data["port"]
+            if not isinstance(device_data["ipv4_ips"], dict) or not isinstance(port, int):
+                raise ValueError("malformed conf.json")
+            ipv4_ips = {e: device_data["ipv4_ips"].get(e, []) for e in ("lan", "wan")}
+        except (tarfile.TarError, ValueError, LookupError, EOFError):
+            return {"result": False}
+
+        existing = [
+            e["controller_id"]
+            for record in MockSubordinatesHandler.subordinates
+            for e in [record] + record["subsubordinates"]
+        ]
+        return {
+            "result": True,
+            "controller_id": controller_id,
+            "ipv4_ips": ipv4_ips,
+            "port": port,
+            "files": files,
+            "exists": controller_id in existing,
+        }
+
     @logger_wrapper(logger)
     def add_sub(self, token) -> dict:
         if app_info["bus"] != "mqtt":
             return {"result": False}
 
+        imported = MockSubordinatesHandler.tokens.get(token)
+        if imported in [e["controller_id"] for e in MockSubordinatesHandler.subordinates]:
+            return {"result": True, "controller_id": imported, "changed": False}
+
         token_data = BytesIO(base64.b64decode(token))
-        with tarfile.open(fileobj=token_data, mode="r:gz") as tar:
+        with tarfile.open(fileobj=token_data, mode="r:*") as tar:
             config_name = [e for e in tar.getmembers() if e.name.endswith("conf.json")][0]
             with tar.extractfile(config_name) as f:
                 device_data = json.load(f)
@@ -82,8 +236,44 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
                 "subsubordinates": [],
             }
         )
+        MockSubordinatesHandler.tokens[token] = controller_id
+
+        return {"result": True, "controller_id": controller_id, "changed": True}
+
+    @logger_wrapper(logger)
+    def token_upload_begin(self) -> dict:
+        upload_id = uuid.uuid4().hex
+        MockSubordinatesHandler.uploads[upload_id] = ""
+        return {"result": True, "upload_id": upload_id}
 
-        return {"result": True, "controller_id": controller_id}
+    @logger_wrapper(logger)
+    def token_upload_chunk(self, upload_id, offset, data) -> dict:
+        if upload_id not in MockSubordinatesHandler.uploads:
+            return {"result": False}
+        size = len(MockSubordinatesHandler.uploads[upload_id])
+        if offset != size:
+            return {"result": False, "size": size}
+        MockSubordinatesHandler.uploads[upload_id] += data
+        return {"result": True, "size": size + len(data)}
+
+    @logger_wrapper(logger)
+    def token_upload_commit(self, upload_id) -> dict:
+        if upload_id not in MockSubordinatesHandler.uploads:
+            return {"result": False}
+        try:
+            return self.add_sub(MockSubordinatesHandler.uploads.pop(upload_id))
+        except (tarfile.TarError, ValueError, LookupError, EOFError):
+            return {"result": False}
+
+    @logger_wrapper(logger)
+    def add_subs(self, tokens) -> typing.List[dict]:
+        res = []
+        for token in tokens:
+            try:
+                res.append(self.add_sub(token))
+            except (tarfile.TarError, ValueError, LookupError, EOFError):
+                res.append({"result": False})
+        return res
 
     @logger_wrapper(logger)
     def delete(self, controller_id) -> bool:
@@ -91,6 +281,10 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
             return False
         return self.del_subordinate(controller_id) or self.del_subsubordinate(controller_id)
 
+    @logger_wrapper(logger)
+    def delete_many(self, controller_ids) -> typing.List[bool]:
+        return [self.delete(controller_id) for controller_id in controller_ids]
+
     def del_subordinate(self, controller_id) -> bool:
         mapped = {e["controller_id"]: e for e in MockSubordinatesHandler.subordinates}
         if controller_id not in mapped:
@@ -107,7 +301,7 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
                     found = record
                     break
             if found:
-                record["subsubordinates"] == [
+                record["subsubordinates"] = [
                     e for e in record["subsubordinates"] if e["controller_id"] != controller_id
                 ]
                 return True
@@ -116,30 +310,23 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
         return False
 
     @logger_wrapper(logger)
-    def set_enabled(self, controller_id, enabled) -> bool:
+    def set_enabled(self, controller_id, enabled) -> dict:
         if app_info["bus"] != "mqtt":
-            return False
-        return self.set_sub_enabled(controller_id, enabled) or self.set_subsub_enabled(
-            controller_id, enabled
-        )
+            return {"result": False}
 
-    @logger_wrapper(logger)
-    def set_subsub_enabled(self, controller_id, enabled) -> bool:
         for record in MockSubordinatesHandler.subordinates:
-            for subsub in record["subsubordinates"]:
-                if controller_id == subsub["controller_id"]:
-                    subsub["enabled"] = enabled
-                    return True
+            for item in [record] + record["subsubordinates"]:
+                if item["controller_id"] == controller_id:
+                    changed = item["enabled"] != enabled
+                    item["enabled"] = enabled
+                    return {"result": True, "changed": changed}
 
         # not found
-        return False
+        return {"result": False}
 
-    def set_sub_enabled(self, controller_id, enabled) -> bool:
-        mapped = {e["controller_id"]: e for e in MockSubordinatesHandler.subordinates}
-        if controller_id not in mapped:
-            return False
-        mapped[controller_id]["enabled"] = enabled
-        return True
+    @logger_wrapper(logger)
+    def set_enabled_many(self, controller_ids, enabled) -> typing.List[dict]:
+        return [self.set_enabled(controller_id, enabled) for controller_id in controller_ids]
 
     @logger_wrapper(logger)
     def add_subsub(self, controller_id, via) -> bool:
@@ -171,35 +358,121 @@ class MockSubordinatesHandler(Handler, BaseMockHandler):
         return True
 
     @logger_wrapper(logger)
-    def restart_mqtt(self):
-        pass  # mock service restart
+    def fsck(self, repair=False) -> dict:
+        # mock records are always consistent
+        return {
+            "orphan_bridge_dirs": [],
+            "missing_bridge_dirs": [],
+            "orphan_subsubordinates": [],
+            "orphan_options": [],
+            "orphan_tokens": 0,
+            "orphan_objects": 0,
+            "temporary": 0,
+            "repaired": repair,
+        }
+
+    @logger_wrapper(logger)
+    def restart_mqtt(self, callback=None):
+        # mock service restart
+        if callback:
+            callback(True)
+
+    @logger_wrapper(logger)
+    def sync(self, subordinates) -> dict:
+        if app_info["bus"] != "mqtt":
+            return {"result": False, "missing": []}
+
+        subsub_ids = [
+            e["controller_id"] for record in subordinates for e in record["subsubordinates"]
+        ]
+        all_ids = [e["controller_id"] for e in subordinates] + subsub_ids
+        if len(set(all_ids)) != len(all_ids) or app_info["controller_id"] in all_ids:
+            return {"result": False, "missing": []}
+
+        current = {e["controller_id"]: e for e in MockSubordinatesHandler.subordinates}
+        missing = [e["controller_id"] for e in subordinates if e["controller_id"] not in current]
+        if missing or any(e in current for e in subsub_ids):
+            return {"result": False, "missing": missing}
+
+        current_subsubs = {
+            e["controller_id"]: (record["controller_id"], e)
+            for record in MockSubordinatesHandler.subordinates
+            for e in record["subsubordinates"]
+        }
+        desired_subsubs = {
+            e["controller_id"]: (record["controller_id"], e)
+            for record in subordinates
+            for e in record["subsubordinates"]
+        }
+
+        affected = [e for e in current_subsubs if e not in desired_subsubs]
+        affected += [e for e in current if e not in {r["controller_id"] for r in subordinates}]
+
+        new_subordinates = []
+        for record in subordinates:
+            old = current[record["controller_id"]]
+            new = {
+                "controller_id": record["controller_id"],
+                "enabled": record["enabled"],
+                "options": {
+                    "custom_name": record["options"]["custom_name"],
+                    "ip_address": record["options"].get(
+                        "ip_address", old["options"]["ip_address"]
+                    ),
+                },
+                "subsubordinates": [
+                    {
+                        "controller_id": e["controller_id"],
+                        "enabled": e["enabled"],
+                        "options": {"custom_name": e["options"]["custom_name"]},
+                    }
+                    for e in record["subsubordinates"]
+                ],
+            }
+            if {k: v for k, v in new.items() if k != "subsubordinates"} != {
+                k: v for k, v in old.items() if k != "subsubordinates"
+            }:
+                affected.append(record["controller_id"])
+            new_subordinates.append(new)
+
+        for controller_id, (via, subsub) in desired_subsubs.items():
+            if controller_id not in current_subsubs or current_subsubs[controller_id] != (
+                via,
+                subsub,
+            ):
+                affected.append(controller_id)
+
+        MockSubordinatesHandler.subordinates = new_subordinates
+        return {"result": True, "controller_ids": affected}
 
     @logger_wrapper(logger)
     def update_sub(
         self, controller_id: str, custom_name: str, ip_address: typing.Optional[str] = None
-    ):
+    ) -> dict:
         if app_info["bus"] != "mqtt":
-            return False
+            return {"result": False}
 
         for record in MockSubordinatesHandler.subordinates:
             if record["controller_id"] == controller_id:
+                old_options = dict(record["options"])
                 record["options"]["custom_name"] = custom_name
                 if ip_address:
                     record["options"]["ip_address"] = ip_address
 
-                return True
+                return {"result": True, "changed": old_options != record["options"]}
 
-        return False
+        return {"result": False}
 
     @logger_wrapper(logger)
-    def update_subsub(self, controller_id: str, custom_name: str):
+    def update_subsub(self, controller_id: str, custom_name: str) -> dict:
         if app_info["bus"] != "mqtt":
-            return False
+            return {"result": False}
 
         for sub in MockSubordinatesHandler.subordinates:
             for subsub in sub["subsubordinates"]:
                 if subsub["controller_id"] == controller_id:
+                    changed = subsub["options"]["custom_name"] != custom_name
                     subsub["options"]["custom_name"] = custom_name
-                    return True
+                    return {"result": True, "changed": changed}
 
-        return False
+        return {"result": False}
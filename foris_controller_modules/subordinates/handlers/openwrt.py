@@ -23,7 +23,8 @@ from foris_controller.handler_base import BaseOpenwrtHandler
 from foris_controller.utils import logger_wrapper
 
 from foris_controller_backends.subordinates import (
-    SubordinatesUci, SubordinatesComplex, SubordinatesService
+    SubordinatesUci, SubordinatesComplex, SubordinatesFiles, SubordinatesService,
+    SubordinatesUploads
 )
 
 from .. import Handler
@@ -36,15 +37,57 @@ class OpenwrtSubordinatesHandler(Handler, BaseOpenwrtHandler):
     uci = SubordinatesUci()
     complex = SubordinatesComplex()
     service = SubordinatesService()
+    uploads = SubordinatesUploads(complex)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # handler is created once when the controller starts
+        SubordinatesFiles.recover()
 
     @logger_wrapper(logger)
     def list_subordinates(self):
         return OpenwrtSubordinatesHandler.uci.list_subordinates()
 
+    @logger_wrapper(logger)
+    def query_subordinates(self, **filters):
+        return OpenwrtSubordinatesHandler.uci.query_subordinates(**filters)
+
+    @logger_wrapper(logger)
+    def changes_since(self, revision):
+        return OpenwrtSubordinatesHandler.uci.changes_since(revision)
+
+    @logger_wrapper(logger)
+    def get_subordinate(self, controller_id):
+        return OpenwrtSubordinatesHandler.uci.get_subordinate(controller_id)
+
+    @logger_wrapper(logger)
+    def stats(self):
+        return OpenwrtSubordinatesHandler.uci.stats()
+
+    @logger_wrapper(logger)
+    def inspect_token(self, token):
+        return OpenwrtSubordinatesHandler.complex.inspect_token(token)
+
     @logger_wrapper(logger)
     def add_sub(self, token):
         return OpenwrtSubordinatesHandler.complex.add_subordinate(token)
 
+    @logger_wrapper(logger)
+    def token_upload_begin(self):
+        return OpenwrtSubordinatesHandler.uploads.begin()
+
+    @logger_wrapper(logger)
+    def token_upload_chunk(self, upload_id, offset, data):
+        return OpenwrtSubordinatesHandler.uploads.chunk(upload_id, offset, data)
+
+    @logger_wrapper(logger)
+    def token_upload_commit(self, upload_id):
+        return OpenwrtSubordinatesHandler.uploads.commit(upload_id)
+
+    @logger_wrapper(logger)
+    def add_subs(self, tokens):
+        return OpenwrtSubordinatesHandler.complex.add_subordinates(tokens)
+
     @logger_wrapper(logger)
     def add_subsub(self, controller_id: str, via: str) -> bool:
         return OpenwrtSubordinatesHandler.uci.add_subsubordinate(controller_id, via)
@@ -58,8 +101,24 @@ class OpenwrtSubordinatesHandler(Handler, BaseOpenwrtHandler):
         return OpenwrtSubordinatesHandler.uci.set_enabled(controller_id, enabled)
 
     @logger_wrapper(logger)
-    def restart_mqtt(self):
-        OpenwrtSubordinatesHandler.service.restart()
+    def delete_many(self, controller_ids):
+        return OpenwrtSubordinatesHandler.complex.delete_many(controller_ids)
+
+    @logger_wrapper(logger)
+    def set_enabled_many(self, controller_ids, enabled):
+        return OpenwrtSubordinatesHandler.uci.set_enabled_many(controller_ids, enabled)
+
+    @logger_wrapper(logger)
+    def fsck(self, repair=False):
+        return OpenwrtSubordinatesHandler.complex.fsck(repair)
+
+    @logger_wrapper(logger)
+    def restart_mqtt(self, callback=None):
+        OpenwrtSubordinatesHandler.service.restart(callback)
+
+    @logger_wrapper(logger)
+    def sync(self, subordinates):
+        return OpenwrtSubordinatesHandler.complex.sync(subordinates)
 
     @logger_wrapper(logger)
     def update_sub(self, controller_id: str, **kwargs):
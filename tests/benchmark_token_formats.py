@@ -0,0 +1,96 @@
+#
+# foris-controller-subordinates-module
+# Copyright (C) 2024 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+""" Compares the import time of tokens in the supported compression formats
+
+The backend's own extraction (SubordinatesFiles.extract_token_subordinate) is
+measured, so foris-controller has to be installed, but it doesn't need to run.
+
+    python3 tests/benchmark_token_formats.py --count 1000
+"""
+
+import argparse
+import base64
+import json
+import os
+import tarfile
+import threading
+import time
+
+from io import BytesIO
+
+from foris_controller.app import app_info
+
+# the backend creates its lock when it is imported (normally set by the running controller)
+app_info.setdefault("lock_backend", threading)
+
+from foris_controller_backends.subordinates import SubordinatesFiles  # noqa: E402
+
+FORMATS = [("gzip", "gz"), ("xz", "xz"), ("bzip2", "bz2"), ("plain tar", "")]
+
+
+def pem(name: str, size: int) -> bytes:
+    body = base64.encodebytes(os.urandom(size)).decode()
+    return ("-----BEGIN %s-----\n%s-----END %s-----\n" % (name, body, name)).encode()
+
+
+def prepare_token(compression: str) -> str:
+    files = {
+        "token.crt": pem("CERTIFICATE", 900),
+        "token.key": pem("PRIVATE KEY", 1200),
+        "ca.crt": pem("CERTIFICATE", 900),
+        "conf.json": json.dumps(
+            {
+                "name": "some_name",
+                "hostname": "localhost",
+                "ipv4_ips": {"lan": ["192.168.1.1"], "wan": []},
+                "dhcp_names": [],
+                "port": 11884,
+                "device_id": "0000000D30000001",
+            }
+        ).encode(),
+    }
+
+    data = BytesIO()
+    with tarfile.open(fileobj=data, mode="w:" + compression) as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name="some_name/" + name)
+            info.size = len(content)
+            info.mode = 0o0600
+            tar.addfile(info, BytesIO(content))
+    return base64.b64encode(data.getvalue()).decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=500, help="imports per format")
+    options = parser.parse_args()
+
+    print("%-10s %12s %15s" % ("format", "token size", "time per token"))
+    for name, compression in FORMATS:
+        token = prepare_token(compression)
+        start = time.perf_counter()
+        for _ in range(options.count):
+            SubordinatesFiles.extract_token_subordinate(token)
+        elapsed = (time.perf_counter() - start) / options.count
+        print("%-10s %10d B %12.1f us" % (name, len(token), elapsed * 1e6))
+
+
+if __name__ == "__main__":
+    main()
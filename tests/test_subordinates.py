@@ -18,10 +18,12 @@
 #
 
 import base64
+import hashlib
 import json
 import pytest
 import tarfile
 import pathlib
+import time
 import typing
 
 from io import BytesIO
@@ -34,7 +36,55 @@ from foris_controller_testtools.fixtures import (
 from foris_controller_testtools.utils import get_uci_module, check_service_result
 
 
-def prepare_subordinate_token(controller_id: str, ip_address: str) -> str:
+# should be greater than SubordinatesService.RESTART_DELAY
+RESTART_TIMEOUT = 5.0
+
+
+def check_fosquitto_restart(expected_found: bool = True):
+    # restarts are coalesced and performed in the background
+    if not expected_found:
+        time.sleep(RESTART_TIMEOUT / 2)
+        check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+        return
+
+    deadline = time.monotonic() + RESTART_TIMEOUT
+    while True:
+        try:
+            check_service_result("fosquitto", "restart", passed=True)
+            return
+        except (AssertionError, OSError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def wait_for(predicate: typing.Callable[[], bool], timeout: float = RESTART_TIMEOUT) -> bool:
+    # for the work which is done in the background
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def request(infrastructure, action: str, data: typing.Optional[dict] = None) -> dict:
+    # data of the reply to a subordinates request (which has to be valid)
+    msg = {"module": "subordinates", "action": action, "kind": "request"}
+    if data is not None:
+        msg["data"] = data
+    res = infrastructure.process_message(msg)
+    assert "errors" not in res
+    return res["data"]
+
+
+def prepare_subordinate_token(
+    controller_id: str,
+    ip_address: str,
+    extra_files: typing.Optional[typing.Dict[str, str]] = None,
+    compression: str = "gz",
+    conf: typing.Optional[dict] = None,
+) -> str:
     def add_to_tar(tar, name, content):
         data = content.encode()
         fake_file = BytesIO(data)
@@ -46,7 +96,7 @@ def prepare_subordinate_token(controller_id: str, ip_address: str) -> str:
         fake_file.close()
 
     new_file = BytesIO()
-    with tarfile.open(fileobj=new_file, mode="w:gz") as tar:
+    with tarfile.open(fileobj=new_file, mode="w:" + compression) as tar:
         add_to_tar(tar, "some_name/token.crt", "token cert content")
         add_to_tar(tar, "some_name/token.key", "token key content")
         add_to_tar(tar, "some_name/ca.crt", "ca cert content")
@@ -61,9 +111,12 @@ def prepare_subordinate_token(controller_id: str, ip_address: str) -> str:
                     "dhcp_names": [],
                     "port": 11884,
                     "device_id": controller_id,
+                    **(conf or {}),
                 }
             ),
         )
+        for name, content in (extra_files or {}).items():
+            add_to_tar(tar, "some_name/" + name, content)
 
     new_file.seek(0)
     final_content = new_file.read()
@@ -77,12 +130,8 @@ def test_complex_subordinates_unsupported(uci_configs_init, infrastructure, file
     res = infrastructure.process_message(
         {"module": "subordinates", "action": "list", "kind": "request"}
     )
-    assert res == {
-        "module": "subordinates",
-        "action": "list",
-        "kind": "reply",
-        "data": {"subordinates": []},
-    }
+    assert "revision" in res["data"]
+    assert res["data"]["subordinates"] == []
     res = infrastructure.process_message(
         {
             "module": "subordinates",
@@ -97,6 +146,20 @@ def test_complex_subordinates_unsupported(uci_configs_init, infrastructure, file
         "kind": "reply",
         "data": {"result": False},
     }
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {"tokens": [prepare_subordinate_token("1122334455667788", "1.1.1.1")]},
+        }
+    )
+    assert res == {
+        "module": "subordinates",
+        "action": "add_subs",
+        "kind": "reply",
+        "data": {"results": [{"result": False}]},
+    }
     res = infrastructure.process_message(
         {
             "module": "subordinates",
@@ -169,11 +232,11 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "module": "subordinates",
         "action": "add_sub",
         "kind": "reply",
-        "data": {"result": True, "controller_id": "1122334455667788"},
+        "data": {"result": True, "controller_id": "1122334455667788", "changed": True},
     }
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
     assert notifications[-1] == {
         "module": "subordinates",
         "action": "add_sub",
@@ -197,7 +260,7 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "data": {"result": False},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+        check_fosquitto_restart(expected_found=False)
 
     assert in_list("1122334455667788") == {
         "controller_id": "1122334455667788",
@@ -219,11 +282,11 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "module": "subordinates",
         "action": "add_sub",
         "kind": "reply",
-        "data": {"result": True, "controller_id": "8877665544332211"},
+        "data": {"result": True, "controller_id": "8877665544332211", "changed": True},
     }
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
     assert notifications[-1] == {
         "module": "subordinates",
         "action": "add_sub",
@@ -252,10 +315,10 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "module": "subordinates",
         "action": "set_enabled",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     assert notifications[-1] == {
         "module": "subordinates",
@@ -284,7 +347,7 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "data": {"result": False},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+        check_fosquitto_restart(expected_found=False)
 
     # del
     filters = [("subordinates", "del")]
@@ -304,7 +367,7 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "data": {"result": True},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     assert notifications[-1] == {
         "module": "subordinates",
@@ -329,7 +392,7 @@ def test_complex_subordinates(uci_configs_init, infrastructure, file_root_init,
         "data": {"result": False},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+        check_fosquitto_restart(expected_found=False)
     assert None is in_list("1122334455667788")
 
 
@@ -347,7 +410,7 @@ def test_complex_subordinates_openwrt(
         "module": "subordinates",
         "action": "add_sub",
         "kind": "reply",
-        "data": {"result": True, "controller_id": "1122334455667788"},
+        "data": {"result": True, "controller_id": "1122334455667788", "changed": True},
     }
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
@@ -380,7 +443,7 @@ def test_complex_subordinates_openwrt(
         "module": "subordinates",
         "action": "set_enabled",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
@@ -479,7 +542,7 @@ def test_complex_subsubordinates(
                 "module": "subordinates",
                 "action": "add_sub",
                 "kind": "reply",
-                "data": {"result": True, "controller_id": controller_id},
+                "data": {"result": True, "controller_id": controller_id, "changed": True},
             }
         else:
             assert res == {
@@ -614,7 +677,7 @@ def test_complex_subsubordinates(
         "module": "subordinates",
         "action": "set_enabled",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     assert notifications[-1] == {
@@ -682,9 +745,9 @@ def test_complex_subsubordinates_openwrt(
             "module": "subordinates",
             "action": "add_sub",
             "kind": "reply",
-            "data": {"result": True, "controller_id": controller_id},
+            "data": {"result": True, "controller_id": controller_id, "changed": True},
         }
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
 
     add_subordinate("4444444444444444", "8.8.8.8")
     add_subordinate("5555555555555555", "9.9.9.9")
@@ -704,7 +767,7 @@ def test_complex_subsubordinates_openwrt(
         "kind": "reply",
         "data": {"result": True},
     }
-    check_service_result("fosquitto", "restart", passed=True)
+    check_fosquitto_restart()
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
         data = backend.read()
@@ -724,9 +787,9 @@ def test_complex_subsubordinates_openwrt(
         "module": "subordinates",
         "action": "set_enabled",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
-    check_service_result("fosquitto", "restart", passed=True)
+    check_fosquitto_restart()
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
         data = backend.read()
@@ -751,7 +814,7 @@ def test_complex_subsubordinates_openwrt(
         "kind": "reply",
         "data": {"result": True},
     }
-    check_service_result("fosquitto", "restart", passed=True)
+    check_fosquitto_restart()
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
         data = backend.read()
@@ -837,7 +900,7 @@ def test_complex_subordinates_options(
         "module": "subordinates",
         "action": "update_sub",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
     assert get_options("1234567887654321") == {"custom_name": "sub1", "ip_address": "10.10.10.10"}
 
@@ -854,7 +917,7 @@ def test_complex_subordinates_options(
         "module": "subordinates",
         "action": "update_subsub",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
     assert get_options("8765432112345678") == {"custom_name": "subsub1"}
 
@@ -906,7 +969,7 @@ def test_complex_subordinates_options_openwrt(
         "module": "subordinates",
         "action": "add_sub",
         "kind": "reply",
-        "data": {"result": True, "controller_id": "3344112266779988"},
+        "data": {"result": True, "controller_id": "3344112266779988", "changed": True},
     }
 
     res = infrastructure.process_message(
@@ -921,7 +984,7 @@ def test_complex_subordinates_options_openwrt(
         "module": "subordinates",
         "action": "update_sub",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
@@ -964,7 +1027,7 @@ def test_complex_subordinates_options_openwrt(
         "module": "subordinates",
         "action": "update_subsub",
         "kind": "reply",
-        "data": {"result": True},
+        "data": {"result": True, "changed": True},
     }
 
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
@@ -1124,7 +1187,7 @@ NSEXxbmbrDG6VR72dTLsmqvynNDn1z6rfGHmB5PAX1i6vQirFz3RvcVCKdZSqf/3J4Kf7bN9ts/2\
         "module": "subordinates",
         "action": "add_sub",
         "kind": "reply",
-        "data": {"result": True, "controller_id": "0000000D30000165"},
+        "data": {"result": True, "controller_id": "0000000D30000165", "changed": True},
     }
 
 
@@ -1167,7 +1230,7 @@ def test_set_ip_address_subordinates(
     )
     assert "errors" not in res
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True)
+        check_fosquitto_restart()
     notifications = infrastructure.get_notifications(notifications, filters=filters)
     assert notifications[-1] == {
         "module": "subordinates",
@@ -1199,7 +1262,7 @@ def test_set_ip_address_subordinates(
         "data": {"controller_id": "1122334455667788", "options": {"custom_name": "nope"},},
     }
     if infrastructure.backend_name == "openwrt":
-        check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+        check_fosquitto_restart(expected_found=False)
 
     assert "112.112.112.112" == ip_in_list("1122334455667788")
 
@@ -1230,7 +1293,7 @@ def test_set_ip_address_subordinates_openwrt(
         }
     )
     assert "errors" not in res
-    check_service_result("fosquitto", "restart", passed=True)
+    check_fosquitto_restart()
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
         data = backend.read()
 
@@ -1248,7 +1311,7 @@ def test_set_ip_address_subordinates_openwrt(
         }
     )
     assert "errors" not in res
-    check_service_result("fosquitto", "restart", passed=True, expected_found=False)
+    check_fosquitto_restart(expected_found=False)
     with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
         data = backend.read()
 
@@ -1256,3 +1319,1555 @@ def test_set_ip_address_subordinates_openwrt(
         uci.get_option_named(data, "fosquitto", "1122334455667788", "address", "")
         == "113.113.113.113"
     )
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_registry_reload_openwrt(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    uci = get_uci_module(infrastructure.name)
+
+    token = prepare_subordinate_token("A000000000000001", "10.0.0.1")
+    assert request(infrastructure, "add_sub", {"token": token})["result"]
+    # fill the cache
+    res = request(infrastructure, "get", {"controller_id": "A000000000000001"})
+    assert res["record"]["options"] == {"custom_name": "", "ip_address": "10.0.0.1"}
+
+    # configs are changed outside of the module
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.set_option("fosquitto", "A000000000000001", "address", "10.0.0.2")
+        backend.set_option("fosquitto", "A000000000000001", "enabled", uci.store_bool(False))
+        backend.add_section("fosquitto", "subsubordinate", "A000000000000002")
+        backend.set_option("fosquitto", "A000000000000002", "via", "A000000000000001")
+        backend.add_section("foris-controller-subordinates", "subordinate", "A000000000000001")
+        backend.set_option(
+            "foris-controller-subordinates", "A000000000000001", "custom_name", "external"
+        )
+
+    expected = {
+        "controller_id": "A000000000000001",
+        "enabled": False,
+        "options": {"custom_name": "external", "ip_address": "10.0.0.2"},
+        "subsubordinates": [
+            {
+                "controller_id": "A000000000000002",
+                "enabled": True,
+                "options": {"custom_name": ""},
+            }
+        ],
+    }
+    assert request(infrastructure, "get", {"controller_id": "A000000000000001"}) == {
+        "result": True,
+        "record": expected,
+    }
+    assert expected in request(infrastructure, "list")["subordinates"]
+
+    # removal outside of the module
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.del_section("fosquitto", "A000000000000002")
+    res = request(infrastructure, "get", {"controller_id": "A000000000000002"})
+    assert res == {"result": False}
+    res = request(infrastructure, "get", {"controller_id": "A000000000000001"})
+    assert res["record"]["subsubordinates"] == []
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_existing_controller_ids_openwrt(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    uci = get_uci_module(infrastructure.name)
+
+    # orphaned subsubordinate section (its via is missing)
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.add_section("fosquitto", "subsubordinate", "B000000000000001")
+        backend.set_option("fosquitto", "B000000000000001", "via", "B0000000000000FF")
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B000000000000001", "11.0.0.1")},
+        }
+    )
+    assert res["data"] == {"result": False}
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B000000000000002", "11.0.0.2")},
+        }
+    )
+    assert res["data"]["result"]
+
+    for controller_id in ["B000000000000001", "B000000000000002"]:
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "add_subsub",
+                "kind": "request",
+                "data": {"controller_id": controller_id, "via": "B000000000000002"},
+            }
+        )
+        assert res["data"] == {"result": False}
+
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        data = backend.read()
+    assert uci.get_option_named(data, "fosquitto", "B000000000000001", "via") == "B0000000000000FF"
+    assert uci.get_section(data, "fosquitto", "B000000000000001")["type"] == "subsubordinate"
+    assert uci.get_section(data, "fosquitto", "B000000000000002")["type"] == "subordinate"
+    assert not pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/B000000000000001").exists()
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_subsub_validation(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B000000000000011", "11.0.0.11")},
+        }
+    )
+    assert res["data"]["result"]
+
+    filters = [("subordinates", "add_subsub")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    def add_subsub(controller_id, via):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "add_subsub",
+                "kind": "request",
+                "data": {"controller_id": controller_id, "via": via},
+            }
+        )
+        assert "errors" not in res
+        return res["data"]["result"]
+
+    # via is missing
+    assert not add_subsub("B000000000000012", "B0000000000000FF")
+    assert add_subsub("B000000000000012", "B000000000000011")
+    # via is a subsubordinate
+    assert not add_subsub("B000000000000013", "B000000000000012")
+
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "add_subsub",
+        "kind": "notification",
+        "data": {"controller_id": "B000000000000012", "via": "B000000000000011"},
+    }
+
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "list", "kind": "request"}
+    )
+    assert {
+        "controller_id": "B000000000000011",
+        "enabled": True,
+        "options": {"custom_name": "", "ip_address": "11.0.0.11"},
+        "subsubordinates": [
+            {"controller_id": "B000000000000012", "enabled": True, "options": {"custom_name": ""}}
+        ],
+    } in res["data"]["subordinates"]
+    assert "B000000000000013" not in json.dumps(res["data"])
+
+    if infrastructure.backend_name == "openwrt":
+        uci = get_uci_module(infrastructure.name)
+        with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+            data = backend.read()
+        assert uci.get_section(data, "fosquitto", "B000000000000012")["type"] == "subsubordinate"
+        assert uci.get_option_named(data, "fosquitto", "B000000000000012", "via") == (
+            "B000000000000011"
+        )
+        assert uci.parse_bool(
+            uci.get_option_named(data, "fosquitto", "B000000000000012", "enabled")
+        )
+        with pytest.raises(uci.UciRecordNotFound):
+            uci.get_section(data, "fosquitto", "B000000000000013")
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_subs(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    filters = [("subordinates", "add_subs")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token("1212121212121212", "5.5.5.5"),
+                    prepare_subordinate_token("3434343434343434", "6.6.6.6"),
+                    prepare_subordinate_token("1212121212121212", "7.7.7.7"),
+                    "invalid token",
+                ]
+            },
+        }
+    )
+    assert res == {
+        "module": "subordinates",
+        "action": "add_subs",
+        "kind": "reply",
+        "data": {
+            "results": [
+                {"result": True, "controller_id": "1212121212121212", "changed": True},
+                {"result": True, "controller_id": "3434343434343434", "changed": True},
+                {"result": False},
+                {"result": False},
+            ]
+        },
+    }
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "add_subs",
+        "kind": "notification",
+        "data": {"controller_ids": ["1212121212121212", "3434343434343434"]},
+    }
+
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "list", "kind": "request"}
+    )
+    records = {e["controller_id"]: e for e in res["data"]["subordinates"]}
+    assert records["1212121212121212"]["options"]["ip_address"] == "5.5.5.5"
+    assert records["3434343434343434"]["options"]["ip_address"] == "6.6.6.6"
+    if infrastructure.backend_name == "openwrt":
+        # files of the batch are published together and the shared content is stored once
+        bridges = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges")
+        assert (bridges / "1212121212121212" / "ca.crt").stat().st_ino == (
+            bridges / "3434343434343434" / "ca.crt"
+        ).stat().st_ino
+        assert not [e for e in bridges.iterdir() if e.name.startswith(".tmp-")]
+        assert not [e for e in (bridges / ".objects").iterdir() if e.name.startswith(".tmp-")]
+
+    # nothing added => no restart
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {"tokens": [prepare_subordinate_token("3434343434343434", "6.6.6.6")]},
+        }
+    )
+    assert res["data"] == {"results": [{"result": False}]}
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart(expected_found=False)
+
+    # the same token passed twice is imported once
+    token = prepare_subordinate_token("C000000000000001", "12.0.0.1")
+    assert request(infrastructure, "add_subs", {"tokens": [token, token]}) == {
+        "results": [
+            {"result": True, "controller_id": "C000000000000001", "changed": True},
+            {"result": True, "controller_id": "C000000000000001", "changed": False},
+        ]
+    }
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_bulk_del_and_set_enabled(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    def list_enabled():
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "list", "kind": "request"}
+        )
+        return {e["controller_id"]: e["enabled"] for e in res["data"]["subordinates"]}
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token("5656565656565656", "5.6.5.6"),
+                    prepare_subordinate_token("7878787878787878", "7.8.7.8"),
+                ]
+            },
+        }
+    )
+    assert all(e["result"] for e in res["data"]["results"])
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+    # set_enabled_many
+    filters = [("subordinates", "set_enabled_many")]
+    notifications = infrastructure.get_notifications(filters=filters)
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "set_enabled_many",
+            "kind": "request",
+            "data": {
+                "controller_ids": ["5656565656565656", "7878787878787878", "9999999999999999"],
+                "enabled": False,
+            },
+        }
+    )
+    assert res == {
+        "module": "subordinates",
+        "action": "set_enabled_many",
+        "kind": "reply",
+        "data": {
+            "results": [
+                {"controller_id": "5656565656565656", "result": True, "changed": True},
+                {"controller_id": "7878787878787878", "result": True, "changed": True},
+                {"controller_id": "9999999999999999", "result": False},
+            ]
+        },
+    }
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "set_enabled_many",
+        "kind": "notification",
+        "data": {"controller_ids": ["5656565656565656", "7878787878787878"], "enabled": False},
+    }
+    enabled = list_enabled()
+    assert enabled["5656565656565656"] is False
+    assert enabled["7878787878787878"] is False
+
+    # del_many
+    filters = [("subordinates", "del_many")]
+    notifications = infrastructure.get_notifications(filters=filters)
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "del_many",
+            "kind": "request",
+            "data": {"controller_ids": ["5656565656565656", "7878787878787878"]},
+        }
+    )
+    assert res == {
+        "module": "subordinates",
+        "action": "del_many",
+        "kind": "reply",
+        "data": {
+            "results": [
+                {"controller_id": "5656565656565656", "result": True},
+                {"controller_id": "7878787878787878", "result": True},
+            ]
+        },
+    }
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "del_many",
+        "kind": "notification",
+        "data": {"controller_ids": ["5656565656565656", "7878787878787878"]},
+    }
+    enabled = list_enabled()
+    assert "5656565656565656" not in enabled
+    assert "7878787878787878" not in enabled
+
+    if infrastructure.backend_name == "openwrt":
+        bridges_root = pathlib.Path(FILE_ROOT_PATH) / "etc" / "fosquitto" / "bridges"
+        assert not (bridges_root / "5656565656565656").exists()
+        assert not (bridges_root / "7878787878787878").exists()
+
+    # nothing to delete => no restart
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "del_many",
+            "kind": "request",
+            "data": {"controller_ids": ["5656565656565656"]},
+        }
+    )
+    assert res["data"] == {"results": [{"controller_id": "5656565656565656", "result": False}]}
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart(expected_found=False)
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_sync(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token("1313131313131313", "1.3.1.3"),
+                    prepare_subordinate_token("2424242424242424", "2.4.2.4"),
+                ]
+            },
+        }
+    )
+    assert all(e["result"] for e in res["data"]["results"])
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subsub",
+            "kind": "request",
+            "data": {"controller_id": "3535353535353535", "via": "1313131313131313"},
+        }
+    )
+    assert res["data"]["result"]
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+    desired = [
+        {
+            "controller_id": "1313131313131313",
+            "enabled": False,
+            "options": {"custom_name": "synced"},
+            "subsubordinates": [
+                {
+                    "controller_id": "3535353535353535",
+                    "enabled": True,
+                    "options": {"custom_name": ""},
+                },
+                {
+                    "controller_id": "4646464646464646",
+                    "enabled": False,
+                    "options": {"custom_name": "new"},
+                },
+            ],
+        }
+    ]
+
+    filters = [("subordinates", "sync")]
+    notifications = infrastructure.get_notifications(filters=filters)
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "sync",
+            "kind": "request",
+            "data": {"subordinates": desired},
+        }
+    )
+    assert res == {
+        "module": "subordinates",
+        "action": "sync",
+        "kind": "reply",
+        "data": {
+            "result": True,
+            "controller_ids": ["2424242424242424", "1313131313131313", "4646464646464646"],
+        },
+    }
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "sync",
+        "kind": "notification",
+        "data": {
+            "controller_ids": ["2424242424242424", "1313131313131313", "4646464646464646"]
+        },
+    }
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "list", "kind": "request"}
+    )
+    records = {e["controller_id"]: e for e in res["data"]["subordinates"]}
+    assert "2424242424242424" not in records
+    assert records["1313131313131313"] == {
+        "controller_id": "1313131313131313",
+        "enabled": False,
+        "options": {"custom_name": "synced", "ip_address": "1.3.1.3"},
+        "subsubordinates": [
+            {
+                "controller_id": "3535353535353535",
+                "enabled": True,
+                "options": {"custom_name": ""},
+            },
+            {
+                "controller_id": "4646464646464646",
+                "enabled": False,
+                "options": {"custom_name": "new"},
+            },
+        ],
+    }
+
+    # already in sync
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "sync",
+            "kind": "request",
+            "data": {"subordinates": desired},
+        }
+    )
+    assert res["data"] == {"result": True, "controller_ids": []}
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart(expected_found=False)
+
+    # subordinates can't be created without a token
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "sync",
+            "kind": "request",
+            "data": {
+                "subordinates": desired
+                + [
+                    {
+                        "controller_id": "5757575757575757",
+                        "enabled": True,
+                        "options": {"custom_name": ""},
+                        "subsubordinates": [],
+                    }
+                ]
+            },
+        }
+    )
+    assert res["data"] == {"result": False, "missing": ["5757575757575757"]}
+
+    # existing subordinate can't become a subsubordinate
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("6868686868686868", "6.8.6.8")},
+        }
+    )
+    assert res["data"]["result"]
+    desired[0]["subsubordinates"].append(
+        {"controller_id": "6868686868686868", "enabled": True, "options": {"custom_name": ""}}
+    )
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "sync",
+            "kind": "request",
+            "data": {"subordinates": desired},
+        }
+    )
+    assert res["data"] == {"result": False, "missing": []}
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "get",
+            "kind": "request",
+            "data": {"controller_id": "6868686868686868"},
+        }
+    )
+    assert res["data"]["record"]["subsubordinates"] == []
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_restarted_notification(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    filters = [("subordinates", "restarted")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    for controller_id, ip_address in [
+        ("6767676767676767", "6.7.6.7"),
+        ("7979797979797979", "7.9.7.9"),
+    ]:
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "add_sub",
+                "kind": "request",
+                "data": {"token": prepare_subordinate_token(controller_id, ip_address)},
+            }
+        )
+        assert res["data"]["result"]
+
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "restarted",
+        "kind": "notification",
+        "data": {"result": True},
+    }
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_restart_delay_openwrt(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    uci = get_uci_module(infrastructure.name)
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.add_section("foris-controller-subordinates", "settings", "settings")
+        backend.set_option("foris-controller-subordinates", "settings", "restart_delay", "4")
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B000000000000031", "11.0.0.31")},
+        }
+    )
+    assert res["data"]["result"]
+    # restart is still waiting for the end of the configured window
+    check_fosquitto_restart(expected_found=False)
+    check_fosquitto_restart()
+
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.del_section("foris-controller-subordinates", "settings")
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_noop_mutations(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    token = prepare_subordinate_token("8080808080808080", "8.0.8.0")
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "add_sub", "kind": "request", "data": {"token": token}}
+    )
+    assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subsub",
+            "kind": "request",
+            "data": {"controller_id": "9090909090909090", "via": "8080808080808080"},
+        }
+    )
+    assert res["data"]["result"]
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+    filters = [
+        ("subordinates", "set_enabled"),
+        ("subordinates", "update_sub"),
+        ("subordinates", "update_subsub"),
+    ]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    for controller_id in ["8080808080808080", "9090909090909090"]:
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "set_enabled",
+                "kind": "request",
+                "data": {"controller_id": controller_id, "enabled": True},
+            }
+        )
+        assert res == {
+            "module": "subordinates",
+            "action": "set_enabled",
+            "kind": "reply",
+            "data": {"result": True, "changed": False},
+        }
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "update_sub",
+            "kind": "request",
+            "data": {
+                "controller_id": "8080808080808080",
+                "options": {"custom_name": "", "ip_address": "8.0.8.0"},
+            },
+        }
+    )
+    assert res["data"] == {"result": True, "changed": False}
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "update_subsub",
+            "kind": "request",
+            "data": {"controller_id": "9090909090909090", "options": {"custom_name": ""}},
+        }
+    )
+    assert res["data"] == {"result": True, "changed": False}
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "set_enabled_many",
+            "kind": "request",
+            "data": {"controller_ids": ["8080808080808080"], "enabled": True},
+        }
+    )
+    assert res["data"] == {
+        "results": [{"controller_id": "8080808080808080", "result": True, "changed": False}]
+    }
+
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart(expected_found=False)
+    assert infrastructure.get_notifications(filters=filters) == notifications
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_restart_on_bridge_changes_openwrt(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B000000000000021", "11.0.0.21")},
+        }
+    )
+    assert res["data"]["result"]
+    check_fosquitto_restart()
+
+    filters = [("subordinates", "restarted")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    # custom_name is not a part of the bridge configuration
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "update_sub",
+            "kind": "request",
+            "data": {
+                "controller_id": "B000000000000021",
+                "options": {"custom_name": "renamed", "ip_address": "11.0.0.21"},
+            },
+        }
+    )
+    assert res["data"] == {"result": True, "changed": True}
+    check_fosquitto_restart(expected_found=False)
+    assert infrastructure.get_notifications(filters=filters) == notifications
+
+    for data in [
+        {
+            "controller_id": "B000000000000021",
+            "options": {"custom_name": "renamed", "ip_address": "11.0.0.22"},
+        },
+        {"controller_id": "B000000000000021", "enabled": False},
+    ]:
+        action = "update_sub" if "options" in data else "set_enabled"
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": action, "kind": "request", "data": data}
+        )
+        assert res["data"] == {"result": True, "changed": True}
+        check_fosquitto_restart()
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_list_filtered(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    controller_ids = ["A100000000000001", "A100000000000002", "A100000000000003"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token(controller_id, "10.0.0.%d" % i)
+                    for i, controller_id in enumerate(controller_ids, 1)
+                ]
+            },
+        }
+    )
+    assert all(e["result"] for e in res["data"]["results"])
+    for controller_id, custom_name in zip(controller_ids, ["router-a", "router-b", "switch"]):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "update_sub",
+                "kind": "request",
+                "data": {"controller_id": controller_id, "options": {"custom_name": custom_name}},
+            }
+        )
+        assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "set_enabled",
+            "kind": "request",
+            "data": {"controller_id": "A100000000000002", "enabled": False},
+        }
+    )
+    assert res["data"]["result"]
+
+    def query(**data):
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "list", "kind": "request", "data": data}
+        )
+        assert "errors" not in res
+        subordinates = [
+            e for e in res["data"]["subordinates"] if e["controller_id"] in controller_ids
+        ]
+        return [e["controller_id"] for e in subordinates], res["data"]["total"]
+
+    ids, total = query(custom_name_prefix="router-")
+    assert ids == ["A100000000000001", "A100000000000002"]
+    assert total == 2
+
+    ids, total = query(custom_name_prefix="router-", enabled=True)
+    assert ids == ["A100000000000001"]
+    assert total == 1
+
+    ids, total = query(via="A100000000000003")
+    assert ids == ["A100000000000003"]
+    assert total == 1
+
+    ids, total = query(custom_name_prefix="router-", offset=1, limit=1)
+    assert ids == ["A100000000000002"]
+    assert total == 2
+
+    ids, total = query(custom_name_prefix="nothing")
+    assert ids == []
+    assert total == 0
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_list_revision(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def list_revision(**data):
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "list", "kind": "request", "data": data}
+        )
+        assert "errors" not in res
+        return res["data"]
+
+    revision = list_revision()["revision"]
+    assert list_revision(if_revision=revision) == {"not_modified": True, "revision": revision}
+
+    token = prepare_subordinate_token("B200000000000001", "11.0.0.1")
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "add_sub", "kind": "request", "data": {"token": token}}
+    )
+    assert res["data"]["result"]
+
+    data = list_revision(if_revision=revision)
+    assert data["revision"] > revision
+    assert "B200000000000001" in [e["controller_id"] for e in data["subordinates"]]
+    revision = data["revision"]
+
+    # custom_name changes are also reflected in revision
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "update_sub",
+            "kind": "request",
+            "data": {"controller_id": "B200000000000001", "options": {"custom_name": "renamed"}},
+        }
+    )
+    assert res["data"]["result"]
+    data = list_revision(if_revision=revision)
+    assert data["revision"] > revision
+    assert "not_modified" not in data
+    assert list_revision(if_revision=data["revision"]) == {
+        "not_modified": True,
+        "revision": data["revision"],
+    }
+
+    if infrastructure.backend_name == "openwrt":
+        # the last revision is stored so it doesn't go back after a reboot
+        path = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/.revision")
+        assert int(path.read_text()) == data["revision"]
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_changes_since(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def changes_since(revision):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "changes_since",
+                "kind": "request",
+                "data": {"revision": revision},
+            }
+        )
+        assert "errors" not in res
+        return res["data"]
+
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "list", "kind": "request"}
+    )
+    revision = res["data"]["revision"]
+    assert changes_since(revision) == {"revision": revision, "changed": [], "removed": []}
+
+    # unknown revision
+    assert changes_since(revision + 1000) == {"resync": True, "revision": revision}
+
+    token = prepare_subordinate_token("C300000000000001", "12.0.0.1")
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "add_sub", "kind": "request", "data": {"token": token}}
+    )
+    assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subsub",
+            "kind": "request",
+            "data": {"controller_id": "C300000000000002", "via": "C300000000000001"},
+        }
+    )
+    assert res["data"]["result"]
+
+    data = changes_since(revision)
+    assert data["revision"] > revision
+    assert data["removed"] == []
+    assert data["changed"] == [
+        {
+            "controller_id": "C300000000000001",
+            "enabled": True,
+            "options": {"custom_name": "", "ip_address": "12.0.0.1"},
+        },
+        {
+            "controller_id": "C300000000000002",
+            "enabled": True,
+            "options": {"custom_name": ""},
+            "via": "C300000000000001",
+        },
+    ]
+    revision = data["revision"]
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "del",
+            "kind": "request",
+            "data": {"controller_id": "C300000000000002"},
+        }
+    )
+    assert res["data"]["result"]
+
+    data = changes_since(revision)
+    assert data["revision"] > revision
+    assert data["changed"] == []
+    assert data["removed"] == ["C300000000000002"]
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_get(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def get(controller_id):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "get",
+                "kind": "request",
+                "data": {"controller_id": controller_id},
+            }
+        )
+        assert "errors" not in res
+        return res["data"]
+
+    token = prepare_subordinate_token("D400000000000001", "13.0.0.1")
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "add_sub", "kind": "request", "data": {"token": token}}
+    )
+    assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subsub",
+            "kind": "request",
+            "data": {"controller_id": "D400000000000002", "via": "D400000000000001"},
+        }
+    )
+    assert res["data"]["result"]
+
+    assert get("D400000000000001") == {
+        "result": True,
+        "record": {
+            "controller_id": "D400000000000001",
+            "enabled": True,
+            "options": {"custom_name": "", "ip_address": "13.0.0.1"},
+            "subsubordinates": [
+                {
+                    "controller_id": "D400000000000002",
+                    "enabled": True,
+                    "options": {"custom_name": ""},
+                }
+            ],
+        },
+    }
+    assert get("D400000000000002") == {
+        "result": True,
+        "record": {
+            "controller_id": "D400000000000002",
+            "enabled": True,
+            "options": {"custom_name": ""},
+            "via": "D400000000000001",
+        },
+    }
+    assert get("D400000000000003") == {"result": False}
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_stats(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def stats():
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "stats", "kind": "request"}
+        )
+        assert "errors" not in res
+        return res["data"]
+
+    before = stats()
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token("E500000000000001", "14.0.0.1"),
+                    prepare_subordinate_token("E500000000000002", "14.0.0.2"),
+                ]
+            },
+        }
+    )
+    assert all(e["result"] for e in res["data"]["results"])
+    for subsub_id in ["E500000000000003", "E500000000000004"]:
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "add_subsub",
+                "kind": "request",
+                "data": {"controller_id": subsub_id, "via": "E500000000000001"},
+            }
+        )
+        assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "set_enabled_many",
+            "kind": "request",
+            "data": {"controller_ids": ["E500000000000002", "E500000000000004"], "enabled": False},
+        }
+    )
+    assert "errors" not in res
+
+    after = stats()
+    assert after["revision"] > before["revision"]
+    assert after["subordinates"]["total"] == before["subordinates"]["total"] + 2
+    assert after["subordinates"]["enabled"] == before["subordinates"]["enabled"] + 1
+    assert after["subordinates"]["disabled"] == before["subordinates"]["disabled"] + 1
+    assert after["subsubordinates"]["total"] == before["subsubordinates"]["total"] + 2
+    assert after["subsubordinates"]["enabled"] == before["subsubordinates"]["enabled"] + 1
+    assert after["subsubordinates"]["disabled"] == before["subsubordinates"]["disabled"] + 1
+    assert after["subsubordinates_per_subordinate"]["E500000000000001"] == 2
+    assert after["subsubordinates_per_subordinate"]["E500000000000002"] == 0
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_list_fields(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("A200000000000001", "10.0.1.1")},
+        }
+    )
+    assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subsub",
+            "kind": "request",
+            "data": {"controller_id": "A200000000000002", "via": "A200000000000001"},
+        }
+    )
+    assert res["data"]["result"]
+
+    def query(**data):
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "list", "kind": "request", "data": data}
+        )
+        assert "errors" not in res
+        return [e for e in res["data"]["subordinates"] if e["controller_id"] == "A200000000000001"]
+
+    assert query(fields=[]) == [{"controller_id": "A200000000000001"}]
+    assert query(fields=["enabled"]) == [{"controller_id": "A200000000000001", "enabled": True}]
+    assert query(fields=["options"], via="A200000000000001") == [
+        {
+            "controller_id": "A200000000000001",
+            "options": {"custom_name": "", "ip_address": "10.0.1.1"},
+        }
+    ]
+    assert query(fields=["subsubordinates", "enabled"]) == [
+        {
+            "controller_id": "A200000000000001",
+            "enabled": True,
+            "subsubordinates": [{"controller_id": "A200000000000002", "enabled": True}],
+        }
+    ]
+    assert query() == query(fields=["enabled", "options", "subsubordinates"])
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "list",
+            "kind": "request",
+            "data": {"fields": ["unknown"]},
+        }
+    )
+    assert "errors" in res
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_sub_token_limits(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def add_sub(token):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "add_sub",
+                "kind": "request",
+                "data": {"token": token},
+            }
+        )
+        assert "errors" not in res
+        return res["data"]["result"]
+
+    # member too large
+    assert not add_sub(
+        prepare_subordinate_token("B100000000000001", "10.1.0.1", {"big": "x" * 300 * 1024})
+    )
+    # total size too large
+    assert not add_sub(
+        prepare_subordinate_token(
+            "B100000000000001", "10.1.0.1", {"part%d" % i: "x" * 200 * 1024 for i in range(6)}
+        )
+    )
+    # too many members
+    assert not add_sub(
+        prepare_subordinate_token(
+            "B100000000000001", "10.1.0.1", {"file%d" % i: "" for i in range(40)}
+        )
+    )
+    # truncated token
+    assert not add_sub(prepare_subordinate_token("B100000000000001", "10.1.0.1")[:100])
+    # not a tarball at all
+    assert not add_sub(base64.b64encode(b"B100000000000001").decode())
+    # malformed conf.json
+    for conf in [
+        {"ipv4_ips": ["10.1.0.1"]},
+        {"ipv4_ips": {"lan": "10.1.0.1"}},
+        {"port": "11884"},
+        {"device_id": "../../config"},
+    ]:
+        assert not add_sub(prepare_subordinate_token("B100000000000001", "10.1.0.1", conf=conf))
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token(
+                        "B100000000000002", "10.1.0.2", conf={"ipv4_ips": ["10.1.0.2"]}
+                    ),
+                    prepare_subordinate_token("B100000000000003", "10.1.0.3"),
+                ]
+            },
+        }
+    )
+    assert [e["result"] for e in res["data"]["results"]] == [False, True]
+    assert not pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/B100000000000002").exists()
+    assert not pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/B100000000000001").exists()
+
+    # token split into lines
+    token = prepare_subordinate_token("B100000000000001", "10.1.0.1")
+    assert add_sub("\n".join(token[i : i + 76] for i in range(0, len(token), 76)))
+    path = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/B100000000000001")
+    assert sorted(e.name for e in path.iterdir() if not e.name.startswith(".")) == [
+        "ca.crt",
+        "conf.json",
+        "token.crt",
+        "token.key",
+    ]
+    assert (path / "token.key").read_text() == "token key content"
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_inspect_token(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    token = prepare_subordinate_token("B200000000000001", "10.2.0.1")
+    res = request(infrastructure, "inspect_token", {"token": token})
+    assert res == {
+        "result": True,
+        "controller_id": "B200000000000001",
+        "ipv4_ips": {"lan": ["10.2.0.1"], "wan": []},
+        "port": 11884,
+        "files": ["ca.crt", "conf.json", "token.crt", "token.key"],
+        "exists": False,
+    }
+    assert "B200000000000001" not in [
+        e["controller_id"] for e in request(infrastructure, "list", {})["subordinates"]
+    ]
+
+    assert request(infrastructure, "add_sub", {"token": token})["result"]
+    assert request(infrastructure, "inspect_token", {"token": token})["exists"]
+
+    assert request(infrastructure, "inspect_token", {"token": "invalid"}) == {"result": False}
+
+    # malformed conf.json
+    token = prepare_subordinate_token("B200000000000002", "10.2.0.2", conf={"ipv4_ips": []})
+    assert request(infrastructure, "inspect_token", {"token": token}) == {"result": False}
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_sub_idempotent(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    token = prepare_subordinate_token("B300000000000001", "10.3.0.1")
+    assert request(infrastructure, "add_sub", {"token": token}) == {
+        "result": True,
+        "controller_id": "B300000000000001",
+        "changed": True,
+    }
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+
+    filters = [("subordinates", "add_sub"), ("subordinates", "add_subs")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    # retried requests
+    assert request(infrastructure, "add_sub", {"token": token}) == {
+        "result": True,
+        "controller_id": "B300000000000001",
+        "changed": False,
+    }
+    assert request(infrastructure, "add_subs", {"tokens": [token]}) == {
+        "results": [{"result": True, "controller_id": "B300000000000001", "changed": False}]
+    }
+    # a different token of an existing device is still refused
+    assert request(
+        infrastructure,
+        "add_sub",
+        {"token": prepare_subordinate_token("B300000000000001", "10.3.0.2")},
+    ) == {"result": False}
+
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart(expected_found=False)
+    assert infrastructure.get_notifications(filters=filters) == notifications
+
+    # the token can be imported again after the device is deleted
+    assert request(infrastructure, "del", {"controller_id": "B300000000000001"})["result"]
+    if infrastructure.backend_name == "openwrt":
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        tokens_dir = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges/.tokens")
+        assert not (tokens_dir / digest).exists()
+    assert request(infrastructure, "add_sub", {"token": token})["changed"]
+
+
+@pytest.mark.only_message_buses(["mqtt"])
+def test_token_upload(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    filters = [("subordinates", "add_sub")]
+    notifications = infrastructure.get_notifications(filters=filters)
+
+    token = prepare_subordinate_token("B400000000000001", "10.4.0.1")
+    res = request(infrastructure, "token_upload_begin")
+    assert res["result"]
+    upload_id = res["upload_id"]
+
+    for offset in range(0, len(token), 100):
+        chunk = token[offset : offset + 100]
+        assert request(
+            infrastructure,
+            "token_upload_chunk",
+            {"upload_id": upload_id, "offset": offset, "data": chunk},
+        ) == {"result": True, "size": offset + len(chunk)}
+
+    # retried chunk is refused and the current size is reported
+    assert request(
+        infrastructure,
+        "token_upload_chunk",
+        {"upload_id": upload_id, "offset": 0, "data": token[:100]},
+    ) == {"result": False, "size": len(token)}
+
+    assert request(infrastructure, "token_upload_commit", {"upload_id": upload_id}) == {
+        "result": True,
+        "controller_id": "B400000000000001",
+        "changed": True,
+    }
+    notifications = infrastructure.get_notifications(notifications, filters=filters)
+    assert notifications[-1] == {
+        "module": "subordinates",
+        "action": "add_sub",
+        "kind": "notification",
+        "data": {"controller_id": "B400000000000001"},
+    }
+    assert "B400000000000001" in [
+        e["controller_id"] for e in request(infrastructure, "list", {})["subordinates"]
+    ]
+    if infrastructure.backend_name == "openwrt":
+        check_fosquitto_restart()
+        assert not pathlib.Path(
+            FILE_ROOT_PATH, "tmp/foris-controller-subordinates-uploads", upload_id
+        ).exists()
+
+    # upload is finished
+    assert request(infrastructure, "token_upload_commit", {"upload_id": upload_id}) == {
+        "result": False
+    }
+    assert request(
+        infrastructure, "token_upload_chunk", {"upload_id": upload_id, "offset": 0, "data": token}
+    ) == {"result": False}
+
+    # invalid token
+    upload_id = request(infrastructure, "token_upload_begin")["upload_id"]
+    assert request(
+        infrastructure,
+        "token_upload_chunk",
+        {"upload_id": upload_id, "offset": 0, "data": token[:100]},
+    )["result"]
+    assert request(infrastructure, "token_upload_commit", {"upload_id": upload_id}) == {
+        "result": False
+    }
+
+    # only ascii line breaks are allowed besides base64
+    upload_id = request(infrastructure, "token_upload_begin")["upload_id"]
+    for data in ["\u3000", "\t"]:
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "token_upload_chunk",
+                "kind": "request",
+                "data": {"upload_id": upload_id, "offset": 0, "data": data},
+            }
+        )
+        assert "errors" in res
+    assert request(
+        infrastructure,
+        "token_upload_chunk",
+        {"upload_id": upload_id, "offset": 0, "data": token[:76] + "\r\n"},
+    ) == {"result": True, "size": 78}
+
+
+@pytest.mark.parametrize(
+    "controller_id,compression",
+    [
+        ("B500000000000001", "gz"),
+        ("B500000000000002", "xz"),
+        ("B500000000000003", "bz2"),
+        ("B500000000000004", ""),
+    ],
+)
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_sub_token_compression(
+    uci_configs_init, infrastructure, file_root_init, init_script_result, controller_id, compression
+):
+    token = prepare_subordinate_token(controller_id, "10.5.0.1", compression=compression)
+    res = infrastructure.process_message(
+        {"module": "subordinates", "action": "add_sub", "kind": "request", "data": {"token": token}}
+    )
+    assert res["data"] == {"result": True, "controller_id": controller_id, "changed": True}
+    if infrastructure.backend_name == "openwrt":
+        path = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges", controller_id)
+        assert (path / "token.key").read_text() == "token key content"
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_add_sub_stale_bridge_dir(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    bridges = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges")
+    stale = bridges / "B700000000000001"
+    stale.mkdir(parents=True, exist_ok=True)
+    (stale / "token.key").write_text("half written")
+    (stale / "garbage").write_text("garbage")
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B700000000000001", "10.7.0.1")},
+        }
+    )
+    assert res["data"]["result"]
+    assert sorted(e.name for e in stale.iterdir() if not e.name.startswith(".")) == [
+        "ca.crt",
+        "conf.json",
+        "token.crt",
+        "token.key",
+    ]
+    assert (stale / "token.key").read_text() == "token key content"
+    # no temporary directories are left behind
+    assert not [e for e in bridges.iterdir() if e.name.startswith(".tmp-")]
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_bridge_files_deduplicated(
+    uci_configs_init, infrastructure, file_root_init, init_script_result
+):
+    bridges = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges")
+    shared = {"shared.crt": "shared content B8"}
+    shared_object = bridges / ".objects" / hashlib.sha256(b"shared content B8").hexdigest()
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_subs",
+            "kind": "request",
+            "data": {
+                "tokens": [
+                    prepare_subordinate_token("B800000000000001", "10.8.0.1", shared),
+                    prepare_subordinate_token("B800000000000002", "10.8.0.2", shared),
+                ]
+            },
+        }
+    )
+    assert all(e["result"] for e in res["data"]["results"])
+
+    first = bridges / "B800000000000001" / "shared.crt"
+    second = bridges / "B800000000000002" / "shared.crt"
+    assert first.stat().st_ino == second.stat().st_ino == shared_object.stat().st_ino
+    assert shared_object.stat().st_nlink == 3
+
+    def delete(controller_id):
+        res = infrastructure.process_message(
+            {
+                "module": "subordinates",
+                "action": "del",
+                "kind": "request",
+                "data": {"controller_id": controller_id},
+            }
+        )
+        assert res["data"]["result"]
+
+    # the object is kept until its last user is removed
+    delete("B800000000000001")
+    assert wait_for(lambda: shared_object.stat().st_nlink == 2)
+    assert second.read_text() == "shared content B8"
+    delete("B800000000000002")
+    assert wait_for(lambda: not shared_object.exists())
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_del_reclaims_trash(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    bridges = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges")
+    # leftover of an interrupted removal
+    leftover = bridges / ".trash" / "leftover"
+    (leftover / "B900000000000000").mkdir(parents=True, exist_ok=True)
+    (leftover / "B900000000000000" / "token.key").write_text("token key content")
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("B900000000000001", "10.9.0.1")},
+        }
+    )
+    assert res["data"]["result"]
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "del",
+            "kind": "request",
+            "data": {"controller_id": "B900000000000001"},
+        }
+    )
+    assert res["data"]["result"]
+    # the directory is gone immediately and it is removed from the trash in the background
+    assert not (bridges / "B900000000000001").exists()
+    assert wait_for(lambda: not list((bridges / ".trash").iterdir()))
+
+
+@pytest.mark.only_backends(["openwrt"])
+@pytest.mark.only_message_buses(["mqtt"])
+def test_fsck(uci_configs_init, infrastructure, file_root_init, init_script_result):
+    def fsck(**data):
+        res = infrastructure.process_message(
+            {"module": "subordinates", "action": "fsck", "kind": "request", "data": data}
+        )
+        assert "errors" not in res
+        return res["data"]
+
+    res = infrastructure.process_message(
+        {
+            "module": "subordinates",
+            "action": "add_sub",
+            "kind": "request",
+            "data": {"token": prepare_subordinate_token("C100000000000001", "10.10.0.1")},
+        }
+    )
+    assert res["data"]["result"]
+
+    bridges = pathlib.Path(FILE_ROOT_PATH, "etc/fosquitto/bridges")
+    (bridges / "C100000000000002").mkdir()
+    (bridges / "C100000000000002" / "token.key").write_text("orphan")
+    (bridges / ".tmp-leftover").mkdir()
+    (bridges / ".tokens" / ("0" * 64)).write_text("C100000000000009")
+    (bridges / ".objects" / ("f" * 64)).write_text("orphan")
+
+    uci = get_uci_module(infrastructure.name)
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        backend.add_section("fosquitto", "subsubordinate", "C100000000000003")
+        backend.set_option("fosquitto", "C100000000000003", "via", "C100000000000009")
+        backend.add_section("foris-controller-subordinates", "subordinate", "C100000000000004")
+        backend.set_option(
+            "foris-controller-subordinates", "C100000000000004", "custom_name", "orphan"
+        )
+
+    res = fsck()
+    assert "C100000000000002" in res["orphan_bridge_dirs"]
+    assert "C100000000000001" not in res["missing_bridge_dirs"]
+    assert "C100000000000003" in res["orphan_subsubordinates"]
+    assert "C100000000000004" in res["orphan_options"]
+    assert res["orphan_tokens"] >= 1
+    assert res["orphan_objects"] >= 1
+    assert res["temporary"] >= 1
+    assert not res["repaired"]
+    # nothing is changed without repair
+    assert (bridges / "C100000000000002").exists()
+
+    assert fsck(repair=True)["repaired"]
+    # objects of removed directories are released in the background
+    assert wait_for(
+        lambda: fsck()
+        == {
+            "orphan_bridge_dirs": [],
+            "missing_bridge_dirs": res["missing_bridge_dirs"],
+            "orphan_subsubordinates": [],
+            "orphan_options": [],
+            "orphan_tokens": 0,
+            "orphan_objects": 0,
+            "temporary": 0,
+            "repaired": False,
+        }
+    )
+    assert not (bridges / "C100000000000002").exists()
+    assert (bridges / "C100000000000001" / "token.key").read_text() == "token key content"
+
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        data = backend.read()
+    with pytest.raises(uci.UciRecordNotFound):
+        uci.get_section(data, "fosquitto", "C100000000000003")
+
+    # options of removed subordinates and subsubordinates are removed as well
+    for controller_id in ["C100000000000005", "C100000000000007"]:
+        token = prepare_subordinate_token(controller_id, "10.10.0.5")
+        assert request(infrastructure, "add_sub", {"token": token})["result"]
+        assert request(
+            infrastructure,
+            "update_sub",
+            {"controller_id": controller_id, "options": {"custom_name": "named"}},
+        )["result"]
+    assert request(
+        infrastructure,
+        "add_subsub",
+        {"controller_id": "C100000000000006", "via": "C100000000000005"},
+    )["result"]
+    assert request(
+        infrastructure,
+        "update_subsub",
+        {"controller_id": "C100000000000006", "options": {"custom_name": "named"}},
+    )["result"]
+    assert request(infrastructure, "del", {"controller_id": "C100000000000005"})["result"]
+    assert fsck()["orphan_options"] == []
+    assert request(infrastructure, "sync", {"subordinates": []})["result"]
+    assert fsck()["orphan_options"] == []
+    with uci.UciBackend(UCI_CONFIG_DIR_PATH) as backend:
+        data = backend.read()
+    assert not uci.get_sections_by_type(data, "foris-controller-subordinates", "subordinate")
+    assert not uci.get_sections_by_type(data, "foris-controller-subordinates", "subsubordinate")